@@ -1,2 +1,48 @@
-from .esmif import esm, prepare_sample_output, sample_seq_multichain
-from .utils import get_chains, get_frequency_of_residues, read_config
+from .cache import ResultCache
+from .compiled import compile_decoder
+from .esmif import (
+    esm,
+    prepare_sample_output,
+    sample_seq_batch,
+    sample_seq_multichain,
+    sample_temperature_sweep,
+)
+from .ledger import DesignLedger
+from .parallel import (
+    DesignSettings,
+    DesignTask,
+    bucket_by_length,
+    run_batched,
+    run_parallel,
+)
+from .precision import get_precision, set_precision
+from .profiling import (
+    JsonLinesSink,
+    LoggingSink,
+    add_sink,
+    clear_sinks,
+    profiling_enabled,
+    remove_sink,
+)
+from .scoring import (
+    check_precision,
+    get_residue_probabilities,
+    saturation_mutagenesis,
+    score_sequences,
+)
+from .stats import (
+    design_matrix,
+    get_diversity,
+    get_entropy,
+    get_frequency,
+    get_recovery,
+    get_uniqueness,
+)
+from .structure import PreparedComplex, pdb_digest, prepare_complex
+from .utils import (
+    get_chains,
+    get_frequency_of_residues,
+    get_replicate_seeds,
+    read_config,
+)
+from .writer import ResultWriter
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import weakref
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+
+from .precision import get_precision
+from .structure import PreparedComplex
+
+# On-disk cache of sampled sequences keyed by everything that determines them:
+# model weights, structure, design, chain order, padding, temperature and seed.
+# Seeded replicates are independent of each other, so an entry holding n
+# samples is the prefix of any larger run and is extended rather than
+# recomputed. Least recently used entries are evicted beyond max_bytes.
+
+# Fingerprint of the weights of each model object, dropped with the model (ids
+# of collected models are reused)
+_model_ids: "weakref.WeakKeyDictionary[GVPTransformerModel, str]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _model_id(model: GVPTransformerModel) -> str:
+    if model not in _model_ids:
+        # Modes sharing the fp32 weights (bf16) sample differently
+        digest = hashlib.sha1(get_precision(model).encode())
+        for name, value in model.state_dict().items():
+            digest.update(name.encode())
+            if isinstance(value, torch.Tensor):
+                digest.update(value.detach().float().cpu().numpy().tobytes())
+        _model_ids[model] = digest.hexdigest()
+    return _model_ids[model]
+
+
+class ResultCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(
+        self,
+        model: GVPTransformerModel,
+        prepared: PreparedComplex,
+        temperature: float,
+        seed: int,
+        crop_radius: Optional[float] = None,
+        crop_margin: int = 3,
+    ) -> str:
+        # Coordinates and padding pattern hold the structure, the fixed
+        # residues, the chain order and the padding between chains
+        digest = hashlib.sha256()
+        digest.update(_model_id(model).encode())
+        digest.update(np.ascontiguousarray(prepared.coords, np.float32).tobytes())
+        unit = [
+            prepared.name,
+            prepared.padding_pattern,
+            prepared.indexes,
+            prepared.chain_order,
+            prepared.padding_length,
+            prepared.target_len,
+            float(temperature),
+            seed,
+            crop_radius,
+            crop_margin,
+        ]
+        digest.update(json.dumps(unit).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Tuple[List[str], List[float]]]:
+        # Samples and recoveries of an entry, marked as recently used
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry["samples"], entry["recoveries"]
+
+    def put(self, key: str, samples: List[str], recoveries: List[float]) -> None:
+        # Write atomically, so concurrent workers never read partial entries
+        path = self._path(key)
+        tmpfile = f"{path}.{os.getpid()}.tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(
+                {
+                    "samples": list(samples),
+                    "recoveries": [float(recovery) for recovery in recoveries],
+                },
+                f,
+            )
+        os.replace(tmpfile, path)
+        self._evict()
+
+    def _evict(self) -> None:
+        # Remove least recently used entries until the cache fits in max_bytes
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
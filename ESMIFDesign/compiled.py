@@ -0,0 +1,110 @@
+import copy
+import os
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+
+from .decoding import DecoderState, _decoder_layers
+
+# Compiled decoder step (torch.compile). The number of rows, the chunk length
+# and the cached prefix change at every step and are compiled as dynamic
+# dimensions. The encoder length (keys of cross-attention) is padded with
+# masked positions to a multiple of LENGTH_BUCKET, so each bucket is compiled
+# once with a static length. Compiled kernels and graphs are stored on disk, so
+# later runs skip most of the compile time.
+
+# Encoder lengths are rounded up to a multiple of LENGTH_BUCKET
+LENGTH_BUCKET = 128
+
+# Compiled graphs kept per step (buckets and specializations of small sizes)
+CACHE_SIZE_LIMIT = 64
+
+
+def length_bucket(length: int) -> int:
+    return -(-length // LENGTH_BUCKET) * LENGTH_BUCKET
+
+
+def _pad_encoder_out(
+    encoder_out: Dict[str, List[torch.Tensor]], length: int
+) -> Dict[str, List[torch.Tensor]]:
+    # Append masked positions to the encoder output (T x B x C) and its padding
+    # mask (B x T). Masked keys get no attention weight, so outputs are the same.
+    states = encoder_out["encoder_out"][0]
+    mask = encoder_out["encoder_padding_mask"][0]
+    T, B, C = states.shape
+    pad_states = states.new_zeros(length - T, B, C)
+    pad_mask = torch.ones(B, length - T, dtype=torch.bool, device=mask.device)
+    return {
+        "encoder_out": [torch.cat([states, pad_states], dim=0)],
+        "encoder_padding_mask": [torch.cat([mask, pad_mask], dim=1)],
+    }
+
+
+class CompiledDecoderStep:
+    def __init__(self, mode: Optional[str] = None):
+        self.mode = mode
+        self._layers = torch.compile(_decoder_layers, mode=mode, dynamic=True)
+
+    def __call__(
+        self,
+        decoder: nn.Module,
+        state: DecoderState,
+        x: torch.Tensor,
+        self_attn_mask: Optional[torch.Tensor],
+        self_attn_padding_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        # Pad the encoder output of a state once, states reordered from it
+        # keep the padded length
+        length = state.encoder_out["encoder_out"][0].size(0)
+        if length != length_bucket(length):
+            state.encoder_out = _pad_encoder_out(
+                state.encoder_out, length_bucket(length)
+            )
+        encoder_out = state.encoder_out["encoder_out"][0]
+        encoder_padding_mask = state.encoder_out["encoder_padding_mask"][0]
+
+        # Encoder length is static within a bucket
+        if hasattr(torch._dynamo, "mark_static"):
+            torch._dynamo.mark_static(encoder_out, 0)
+            torch._dynamo.mark_static(encoder_padding_mask, 1)
+
+        return self._layers(
+            decoder,
+            x,
+            encoder_out,
+            encoder_padding_mask,
+            state.incremental_state,
+            self_attn_mask,
+            self_attn_padding_mask,
+        )
+
+
+def compile_decoder(
+    model: GVPTransformerModel,
+    cache_dir: Optional[str] = os.path.join(".cache", "compile"),
+    mode: Optional[str] = None,
+) -> GVPTransformerModel:
+    # Return a model (sharing weights) whose decoder step is compiled. mode is
+    # passed to torch.compile (e.g. "reduce-overhead", "max-autotune").
+    if not hasattr(torch, "compile"):
+        raise ImportError("compile_decoder requires torch>=2.0 (torch.compile)")
+    import torch._dynamo
+    import torch._inductor.config
+
+    # Persistent cache of compiled kernels and graphs (an existing
+    # TORCHINDUCTOR_CACHE_DIR takes precedence)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+        if hasattr(torch._inductor.config, "fx_graph_cache"):
+            torch._inductor.config.fx_graph_cache = True
+
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, CACHE_SIZE_LIMIT
+    )
+
+    model = copy.copy(model)
+    model.decoder_step = CompiledDecoderStep(mode)
+    return model
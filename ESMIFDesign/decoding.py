@@ -0,0 +1,773 @@
+import hashlib
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from esm.data import Alphabet
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+from esm.inverse_folding.util import CoordBatchConverter
+
+from .precision import autocast
+
+# Decoding loop based on GVPTransformerModel.sample from fair-esm, split so the
+# GVP encoder output can be computed once per structure and reused by every
+# sample drawn from it.
+# https://github.com/facebookresearch/esm/blob/main/esm/inverse_folding/gvp_transformer.py
+
+# Maximum number of encoded structures kept in memory
+ENCODER_CACHE_SIZE = 8
+
+# Encoded structures of each model object, dropped with the model (ids of
+# collected models are reused, e.g. by the copies of set_precision)
+_encoder_cache: "weakref.WeakKeyDictionary[GVPTransformerModel, OrderedDict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _coords_key(coords: np.ndarray, device: str) -> str:
+    # Concatenated coordinates already encode the structure, the chain order and
+    # the padding between chains
+    digest = hashlib.sha1(np.ascontiguousarray(coords, dtype=np.float32).tobytes())
+    return f"{device}:{coords.shape}:{digest.hexdigest()}"
+
+
+def clear_encoder_cache() -> None:
+    _encoder_cache.clear()
+
+
+@torch.no_grad()
+def encode_structure(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    coords: np.ndarray,
+    device: str = "cpu",
+) -> Dict[str, List[torch.Tensor]]:
+    # Return cached encoder output when the same coordinates were encoded before
+    cache = _encoder_cache.setdefault(model, OrderedDict())
+    key = _coords_key(coords, device)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    # Convert to batch format
+    batch_converter = CoordBatchConverter(alphabet)
+    batch_coords, confidence, _, _, padding_mask = batch_converter(
+        [(coords, None, None)], device=device
+    )
+
+    # Run GVP encoder
+    with autocast(model):
+        encoder_out = model.encoder(batch_coords, padding_mask, confidence)
+
+    # Store encoder output and evict least recently used structures
+    cache[key] = encoder_out
+    while len(cache) > ENCODER_CACHE_SIZE:
+        cache.popitem(last=False)
+
+    return encoder_out
+
+
+@torch.no_grad()
+def encode_structures(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    coords_list: List[np.ndarray],
+    device: str = "cpu",
+) -> Dict[str, List[torch.Tensor]]:
+    # Encode several structures as one padded batch (not cached). Padding is
+    # excluded through the encoder padding mask.
+    batch_converter = CoordBatchConverter(alphabet)
+    batch_coords, confidence, _, _, padding_mask = batch_converter(
+        [(coords, None, None) for coords in coords_list], device=device
+    )
+    with autocast(model):
+        return model.encoder(batch_coords, padding_mask, confidence)
+
+
+@dataclass
+class DecoderState:
+    # Encoder output (T x B x C and B x T), per-layer key/value cache of the
+    # decoder and number of tokens already consumed by the decoder
+    encoder_out: Dict[str, List[torch.Tensor]]
+    incremental_state: Dict[str, Dict[str, Optional[torch.Tensor]]] = field(
+        default_factory=dict
+    )
+    length: int = 0
+
+
+def _select_encoder_out(
+    encoder_out: Dict[str, List[torch.Tensor]], order: torch.Tensor
+) -> Dict[str, List[torch.Tensor]]:
+    return {
+        "encoder_out": [encoder_out["encoder_out"][0].index_select(1, order)],
+        "encoder_padding_mask": [
+            encoder_out["encoder_padding_mask"][0].index_select(0, order)
+        ],
+    }
+
+
+def _select_buffer(
+    buffer: Dict[str, Optional[torch.Tensor]], order: torch.Tensor
+) -> Dict[str, Optional[torch.Tensor]]:
+    return {
+        name: None if value is None else value.index_select(0, order)
+        for name, value in buffer.items()
+    }
+
+
+def _reorder_state(
+    state: DecoderState,
+    order: torch.Tensor,
+    shared: Optional[DecoderState] = None,
+) -> DecoderState:
+    # Select (or repeat) batch rows of the encoder output and every cached
+    # key, value and padding mask, leaving the original state untouched
+    if shared is None:
+        encoder_out, static = _select_encoder_out(state.encoder_out, order), {}
+    else:
+        # Rows of the shared buffers are identical, so the first ones are
+        # sliced instead of copied (see _shared_state)
+        n = order.size(0)
+        encoder_out = {
+            "encoder_out": [shared.encoder_out["encoder_out"][0][:, :n]],
+            "encoder_padding_mask": [shared.encoder_out["encoder_padding_mask"][0][:n]],
+        }
+        static = {
+            key: {
+                name: None if value is None else value[:n]
+                for name, value in buffer.items()
+            }
+            for key, buffer in shared.incremental_state.items()
+        }
+    incremental_state = {
+        key: static[key] if key in static else _select_buffer(buffer, order)
+        for key, buffer in state.incremental_state.items()
+    }
+    return DecoderState(encoder_out, incremental_state, state.length)
+
+
+def _shared_state(
+    model: GVPTransformerModel, state: DecoderState, rows: int
+) -> DecoderState:
+    # Encoder output and encoder-decoder attention keys and values of a state
+    # holding one structure, repeated once for up to rows sequences. They are
+    # the same for every sequence, so states reordered with it only copy the
+    # self-attention cache.
+    device = state.encoder_out["encoder_out"][0].device
+    order = torch.zeros(rows, dtype=int, device=device)
+    static = {
+        layer.encoder_attn._get_full_incremental_state_key("attn_state")
+        for layer in model.decoder.layers
+    }
+    incremental_state = {
+        key: _select_buffer(buffer, order)
+        for key, buffer in state.incremental_state.items()
+        if key in static
+    }
+    encoder_out = _select_encoder_out(state.encoder_out, order)
+    return DecoderState(encoder_out, incremental_state, state.length)
+
+
+def _position_table(
+    model: GVPTransformerModel, alphabet: Alphabet, length: int, device: str
+) -> torch.Tensor:
+    # Sinusoidal embeddings of positions 0..length-1 for non-padding tokens
+    tokens = torch.full((1, length), alphabet.get_idx("<cath>"), device=device)
+    return model.decoder.embed_positions(tokens)[0]
+
+
+def _decoder_layers(
+    decoder: nn.Module,
+    x: torch.Tensor,
+    encoder_out: torch.Tensor,
+    encoder_padding_mask: torch.Tensor,
+    incremental_state: Dict[str, Dict[str, Optional[torch.Tensor]]],
+    self_attn_mask: Optional[torch.Tensor],
+    self_attn_padding_mask: torch.Tensor,
+) -> torch.Tensor:
+    # Run a chunk x [c, B, C] through every decoder layer
+    for layer in decoder.layers:
+        x = layer(
+            x,
+            encoder_out,
+            encoder_padding_mask,
+            incremental_state,
+            self_attn_mask=self_attn_mask,
+            self_attn_padding_mask=self_attn_padding_mask,
+        )[0]
+    return x
+
+
+def _decoder_step(
+    decoder: nn.Module,
+    state: DecoderState,
+    x: torch.Tensor,
+    self_attn_mask: Optional[torch.Tensor],
+    self_attn_padding_mask: torch.Tensor,
+) -> torch.Tensor:
+    # Eager decoder step (see compile_decoder for the compiled one)
+    return _decoder_layers(
+        decoder,
+        x,
+        state.encoder_out["encoder_out"][0],
+        state.encoder_out["encoder_padding_mask"][0],
+        state.incremental_state,
+        self_attn_mask,
+        self_attn_padding_mask,
+    )
+
+
+def _decode_chunk(
+    model: GVPTransformerModel,
+    state: DecoderState,
+    tokens: torch.Tensor,
+    positions: torch.Tensor,
+    outputs: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    # Teacher-force a chunk of tokens [B, c] following the cached prefix and
+    # return logits [B, n, V] at the chunk positions in outputs (default: last)
+    decoder = model.decoder
+    start, c = state.length, tokens.size(1)
+
+    # Embed tokens and positions (padding tokens have no position)
+    padding_mask = tokens.eq(decoder.padding_idx)
+    x = decoder.embed_scale * decoder.embed_tokens(tokens)
+    if getattr(decoder, "project_in_dim", None) is not None:
+        x = decoder.project_in_dim(x)
+    x = x + positions[start : start + c] * (~padding_mask).unsqueeze(-1).to(x.dtype)
+    x = decoder.dropout_module(x)
+
+    # B x T x C -> T x B x C
+    x = x.transpose(0, 1)
+
+    # Causal mask of the chunk against the cached prefix and itself
+    self_attn_mask = None
+    if c > 1:
+        self_attn_mask = torch.triu(
+            torch.full((c, start + c), float("-inf"), device=x.device),
+            diagonal=start + 1,
+        ).to(x.dtype)
+
+    # Decoder layers append the chunk keys and values to the cache (logits are
+    # in bf16 under bf16 autocast, callers convert them before softmax)
+    step = getattr(model, "decoder_step", _decoder_step)
+    with autocast(model):
+        x = step(decoder, state, x, self_attn_mask, padding_mask)
+        state.length += c
+
+        # Only project requested positions to the vocabulary
+        x = x[-1:] if outputs is None else x.index_select(0, outputs)
+        if decoder.layer_norm is not None:
+            x = decoder.layer_norm(x)
+
+        # T x B x C -> B x T x C
+        x = x.transpose(0, 1)
+        if getattr(decoder, "project_out_dim", None) is not None:
+            x = decoder.project_out_dim(x)
+
+        return decoder.output_layer(x)
+
+
+def tokenize(alphabet: Alphabet, partial_seq: List[str], device: str) -> torch.Tensor:
+    # Prepend token followed by the partial sequence, as a [1, 1 + L] tensor
+    tokens = torch.tensor(
+        [alphabet.get_idx("<cath>")] + [alphabet.get_idx(c) for c in partial_seq]
+    )
+    return tokens.unsqueeze(0).to(device)
+
+
+@torch.no_grad()
+def forward_logits(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    tokens: torch.Tensor,
+    targets: List[int],
+) -> torch.Tensor:
+    # Teacher-forced logits [B, P, V] predicting tokens [B, 1 + L] at the
+    # (sorted) target positions. Rows must only differ at target positions.
+    B = tokens.size(0)
+    positions = _position_table(model, alphabet, tokens.size(1), tokens.device)
+
+    # Prefix up to the first target is shared by every row
+    state = DecoderState(encoder_out)
+    logits = _decode_chunk(model, state, tokens[:1, : targets[0]], positions)
+    logits = logits.expand(B, -1, -1)
+    if len(targets) == 1:
+        return logits
+
+    # Remaining targets in one parallel chunk
+    order = torch.zeros(B, dtype=int, device=tokens.device)
+    batch_state = _reorder_state(state, order)
+    outputs = torch.tensor(targets[1:], device=tokens.device) - 1 - targets[0]
+    chunk = tokens[:, targets[0] : targets[-1]]
+    rest = _decode_chunk(model, batch_state, chunk, positions, outputs)
+
+    return torch.cat([logits, rest], dim=1)
+
+
+@torch.no_grad()
+def score_tokens(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    template: torch.Tensor,
+    targets: List[int],
+    candidates: torch.Tensor,
+    batch_size: int = 32,
+) -> torch.Tensor:
+    # Log-likelihood [N, P] of candidate tokens [N, P] placed at the (sorted)
+    # target positions of template [1, 1 + L]
+    N, P = candidates.shape
+    device = template.device
+    positions = _position_table(model, alphabet, template.size(1), device)
+
+    # Prefix up to the first target is decoded once for all candidates
+    state = DecoderState(encoder_out)
+    prefix = _decode_chunk(model, state, template[:, : targets[0]], positions)
+    prefix_logp = F.log_softmax(prefix[0, -1].float(), dim=-1)
+
+    targets_idx = torch.tensor(targets, device=device)
+    outputs = targets_idx[1:] - 1 - targets[0]
+    logp = torch.empty(N, P)
+    for start in range(0, N, batch_size):
+        batch = candidates[start : start + batch_size].to(device)
+        n = batch.size(0)
+        logp[start : start + n, 0] = prefix_logp[batch[:, 0]].cpu()
+        if P == 1:
+            continue
+
+        # Remaining targets of every candidate in one parallel chunk
+        tokens = template.repeat(n, 1)
+        tokens[:, targets_idx] = batch
+        order = torch.zeros(n, dtype=int, device=device)
+        batch_state = _reorder_state(state, order)
+        chunk = tokens[:, targets[0] : targets[-1]]
+        logits = _decode_chunk(model, batch_state, chunk, positions, outputs)
+        batch_logp = F.log_softmax(logits.float(), dim=-1)
+        batch_logp = batch_logp.gather(-1, batch[:, 1:].unsqueeze(-1)).squeeze(-1)
+        logp[start : start + n, 1:] = batch_logp.cpu()
+
+    return logp
+
+
+@torch.no_grad()
+def scan_tokens(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    template: torch.Tensor,
+    targets: List[int],
+    substitutions: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # Log-likelihood of target positions k..P-1 when target k of template
+    # [1, 1 + L] is replaced by each of substitutions [S], for every k.
+    # Returns mutant [P, S] and native [P] log-likelihoods.
+    P, S = len(targets), substitutions.size(0)
+    device = template.device
+    positions = _position_table(model, alphabet, template.size(1), device)
+    native = template[0, targets]
+
+    # Native sequence is decoded incrementally, one designed span at a time
+    state = DecoderState(encoder_out)
+    logits = _decode_chunk(model, state, template[:, : targets[0]], positions)[0, -1]
+
+    mutant_logp, native_logp = torch.zeros(P, S), torch.zeros(P)
+    order = torch.zeros(S, dtype=int, device=device)
+    for k, i in enumerate(targets):
+        logp = F.log_softmax(logits.float(), dim=-1)
+        native_logp[k] = logp[native[k]].cpu()
+        mutant_logp[k] = logp[substitutions].cpu()
+
+        if k == P - 1:
+            break
+
+        # Positions before k are shared with the native sequence, so mutants
+        # only decode from position k onwards
+        mutants = template.repeat(S, 1)
+        mutants[:, i] = substitutions
+        mutant_state = _reorder_state(state, order)
+        outputs = torch.tensor(targets[k + 1 :], device=device) - 1 - i
+        chunk = mutants[:, i : targets[-1]]
+        downstream = _decode_chunk(model, mutant_state, chunk, positions, outputs)
+        downstream = F.log_softmax(downstream.float(), dim=-1)
+        downstream = downstream.gather(
+            -1, native[k + 1 :].expand(S, -1).unsqueeze(-1)
+        ).squeeze(-1)
+        mutant_logp[k] += downstream.sum(dim=-1).cpu()
+
+        # Advance native sequence to the next designed position
+        chunk = template[:, i : targets[k + 1]]
+        logits = _decode_chunk(model, state, chunk, positions)[0, -1]
+
+    # Native log-likelihood of positions k..P-1
+    native_suffix = native_logp.flip(0).cumsum(0).flip(0)
+
+    return mutant_logp, native_suffix
+
+
+def _replicate_uniforms(
+    seeds: Optional[List[int]], num_samples: int, num_positions: int
+) -> torch.Tensor:
+    # One uniform draw per replicate and designed position. Seeded replicates
+    # use their own generator so a replicate is sampled identically whatever
+    # the batch, worker or order it runs in.
+    if seeds is None:
+        return torch.rand(num_samples, num_positions)
+    uniforms = torch.empty(num_samples, num_positions)
+    for replicate, seed in enumerate(seeds):
+        generator = torch.Generator().manual_seed(seed)
+        uniforms[replicate] = torch.rand(num_positions, generator=generator)
+    return uniforms
+
+
+def _sample_from_probs(probs: torch.Tensor, uniforms: torch.Tensor) -> torch.Tensor:
+    # Inverse transform sampling of one token per row of probs [B, V]
+    cdf = probs.cumsum(dim=-1)
+    u = uniforms.unsqueeze(-1) * cdf[:, -1:]
+    tokens = torch.searchsorted(cdf, u, right=True).squeeze(-1)
+    return tokens.clamp(max=probs.size(-1) - 1)
+
+
+def _prepare_sampling(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    partial_seq: List[str],
+    device: str,
+) -> Tuple[torch.Tensor, List[int], torch.Tensor, DecoderState, torch.Tensor]:
+    # Prepare template with prepend token and partial sequence
+    mask_idx = alphabet.get_idx("<mask>")
+    template = tokenize(alphabet, partial_seq, device)
+
+    # Designed positions are the only ones decoded one token at a time
+    designed = (template[0] == mask_idx).nonzero().squeeze(-1).tolist()
+    positions = _position_table(model, alphabet, template.size(1), device)
+
+    # Teacher-force the fixed prefix once, shared by every sample
+    state = DecoderState(encoder_out)
+    prefix_logits = None
+    if len(designed) > 0:
+        prefix_logits = _decode_chunk(
+            model, state, template[:, : designed[0]], positions
+        )[:, -1]
+
+    return template, designed, positions, state, prefix_logits
+
+
+def _sample_rows(
+    model: GVPTransformerModel,
+    state: DecoderState,
+    prefix_logits: torch.Tensor,
+    templates: torch.Tensor,
+    designed_mask: torch.Tensor,
+    union: List[int],
+    positions: torch.Tensor,
+    row_struct: torch.Tensor,
+    row_temps: torch.Tensor,
+    row_uniforms: torch.Tensor,
+) -> Tuple[torch.Tensor, int]:
+    # Sample rows of the structures in templates [S, 1 + L], whose prefix up to
+    # union[0] is decoded in state (batch S, logits [S, V]). Row r follows
+    # structure row_struct[r] at temperature row_temps[r] [R, 1] with uniforms
+    # row_uniforms[r] [R, U], one per position of union (the sorted designed
+    # positions of all structures). Positions not designed in the structure of
+    # a row keep its template token. Also returns the number of sequences
+    # decoded over all chunks (decoder passes).
+    rows = templates.index_select(0, row_struct)
+
+    # Every row starts from the prefix of its structure
+    group = row_struct
+    group_struct = torch.arange(templates.size(0), device=templates.device)
+    group_state, logits = state, prefix_logits
+    passes = 0
+
+    # Encoder buffers of a single structure are repeated once for every row,
+    # not copied again at every reorder
+    shared = None
+    if templates.size(0) == 1:
+        shared = _shared_state(model, state, rows.size(0))
+
+    for k, i in enumerate(union):
+        # Logits are computed once per distinct prefix and rescaled by the
+        # temperature of each row
+        probs = F.softmax(logits[group].float() / row_temps, dim=-1)
+        sampled = _sample_from_probs(probs, row_uniforms[:, k])
+        rows[:, i] = torch.where(designed_mask[row_struct, i], sampled, rows[:, i])
+
+        if k == len(union) - 1:
+            break
+
+        # Rows sharing the same prefix (frequent at low temperature) are
+        # decoded once
+        keys = group * logits.size(-1) + rows[:, i]
+        unique, group = torch.unique(keys, return_inverse=True)
+        parents = torch.div(unique, logits.size(-1), rounding_mode="floor")
+
+        # When every prefix was extended by a single token (frequent at high
+        # temperature), the state keeps its rows. The prefix state is shared by
+        # every call, so it is always copied before being extended.
+        identity = torch.arange(logits.size(0), device=parents.device)
+        if group_state is state or not torch.equal(parents, identity):
+            group_state = _reorder_state(group_state, parents, shared)
+            group_struct = group_struct[parents]
+
+        # Fixed residues and padding up to the next designed position are
+        # processed as one parallel chunk
+        chunk = templates.index_select(0, group_struct)[:, i : union[k + 1]]
+        chunk[:, 0] = unique % logits.size(-1)
+        logits = _decode_chunk(model, group_state, chunk, positions)[:, -1]
+        passes += unique.size(0)
+
+    return rows, passes
+
+
+def _sample_block(
+    model: GVPTransformerModel,
+    state: DecoderState,
+    prefix_logits: torch.Tensor,
+    template: torch.Tensor,
+    designed: List[int],
+    positions: torch.Tensor,
+    temperatures: torch.Tensor,
+    uniforms: torch.Tensor,
+) -> Tuple[torch.Tensor, int]:
+    # Sample n replicates (uniforms [n, P]) at T temperatures as [n * T, 1 + L]
+    # tokens, row r * T + t holding replicate r at temperature t
+    n, T = uniforms.size(0), temperatures.size(0)
+    row_struct = torch.zeros(n * T, dtype=int, device=template.device)
+    return _sample_rows(
+        model,
+        state,
+        prefix_logits,
+        template,
+        torch.ones_like(template, dtype=torch.bool),
+        designed,
+        positions,
+        row_struct,
+        temperatures.repeat(n).unsqueeze(-1),
+        uniforms.repeat_interleave(T, dim=0),
+    )
+
+
+@torch.no_grad()
+def sample_sweep(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    partial_seq: List[str],
+    temperatures: List[float],
+    num_samples: int = 1,
+    batch_size: int = 1,
+    device: str = "cpu",
+    seeds: Optional[List[int]] = None,
+) -> torch.Tensor:
+    # Sample num_samples sequences at every temperature, as tokens [T, N, L]
+    # without the prepend token. Replicate r uses the same random numbers at
+    # every temperature, so it is the sequence a single-temperature run with
+    # the same seeds would sample.
+    T = len(temperatures)
+    template, designed, positions, state, prefix_logits = _prepare_sampling(
+        model, alphabet, encoder_out, partial_seq, device
+    )
+
+    # Random numbers driving the choice at every designed position
+    uniforms = _replicate_uniforms(seeds, num_samples, len(designed)).to(device)
+
+    # Blocks hold batch_size // T replicates (at least one), which bounds the
+    # number of distinct prefixes decoded in parallel
+    temps = torch.tensor(temperatures, dtype=torch.float32, device=device)
+    block = max(1, batch_size // max(1, T))
+    sampled = []
+    for start in range(0, num_samples, block):
+        rows, _ = _sample_block(
+            model,
+            state,
+            prefix_logits,
+            template,
+            designed,
+            positions,
+            temps,
+            uniforms[start : start + block],
+        )
+        sampled.append(rows)
+
+    # Rows are (replicate, temperature) pairs
+    sampled = torch.cat(sampled) if sampled else template[:0]
+    sampled = sampled.view(num_samples, T, template.size(1))
+    return sampled.transpose(0, 1)[:, :, 1:]
+
+
+@torch.no_grad()
+def sample_distinct(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    partial_seq: List[str],
+    num_unique: int,
+    temperature: float = 1.0,
+    batch_size: int = 1,
+    device: str = "cpu",
+    seeds: Optional[List[int]] = None,
+    max_samples: int = 1000,
+) -> Tuple[torch.Tensor, int, int]:
+    # Sample until num_unique sequences with distinct designed residues are
+    # found or max_samples replicates were drawn (seeds, when given, must hold
+    # max_samples seeds). Returns the distinct sequences in the order they
+    # were drawn (tokens [K, L] without the prepend token), the number of
+    # replicates drawn and the decoder passes spent.
+    template, designed, positions, state, prefix_logits = _prepare_sampling(
+        model, alphabet, encoder_out, partial_seq, device
+    )
+
+    # Without designed positions there is a single possible sequence
+    if len(designed) == 0:
+        return template[:, 1:], 1, 0
+
+    temps = torch.tensor([temperature], dtype=torch.float32, device=device)
+    designed_idx = torch.tensor(designed, dtype=int, device=device)
+    passes = 1
+
+    # Designed residues already seen, as tuples of tokens
+    seen, sampled_seqs = set(), []
+    drawn = 0
+    while len(sampled_seqs) < num_unique and drawn < max_samples:
+        n = min(batch_size, max_samples - drawn)
+        uniforms = _replicate_uniforms(
+            None if seeds is None else seeds[drawn : drawn + n], n, len(designed)
+        ).to(device)
+        rows, block_passes = _sample_block(
+            model,
+            state,
+            prefix_logits,
+            template,
+            designed,
+            positions,
+            temps,
+            uniforms,
+        )
+        passes += block_passes
+
+        # Reject duplicates, stopping at the replicate that completes the set
+        keys = rows.index_select(1, designed_idx).tolist()
+        for replicate, key in enumerate(keys):
+            drawn += 1
+            if tuple(key) in seen:
+                continue
+            seen.add(tuple(key))
+            sampled_seqs.append(rows[replicate, 1:])
+            if len(sampled_seqs) == num_unique:
+                break
+
+    sampled = torch.stack(sampled_seqs) if sampled_seqs else template[:0, 1:]
+    return sampled, drawn, passes
+
+
+@torch.no_grad()
+def sample_sequences(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    partial_seq: List[str],
+    num_samples: int = 1,
+    temperature: float = 1.0,
+    batch_size: int = 1,
+    device: str = "cpu",
+    seeds: Optional[List[int]] = None,
+) -> torch.Tensor:
+    # Single temperature sweep, as tokens [N, L] without the prepend token
+    return sample_sweep(
+        model,
+        alphabet,
+        encoder_out,
+        partial_seq,
+        [temperature],
+        num_samples=num_samples,
+        batch_size=batch_size,
+        device=device,
+        seeds=seeds,
+    )[0]
+
+
+@torch.no_grad()
+def sample_structures(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    partial_seqs: List[List[str]],
+    num_samples: int = 1,
+    temperature: float = 1.0,
+    batch_size: int = 1,
+    device: str = "cpu",
+    seeds: Optional[List[List[int]]] = None,
+) -> List[torch.Tensor]:
+    # Sample num_samples sequences of each of S structures encoded together
+    # (encode_structures), decoding all structures in the same batch, as
+    # tokens [N, L_s] without the prepend token. Seeds, when given, hold the
+    # replicate seeds of each structure, so every structure is sampled as it
+    # would be on its own.
+    S = len(partial_seqs)
+    lengths = [len(partial_seq) for partial_seq in partial_seqs]
+
+    # Templates padded to the longest structure (trailing padding tokens are
+    # masked like the padding between chains)
+    templates = torch.full(
+        (S, 1 + max(lengths)), alphabet.padding_idx, dtype=int, device=device
+    )
+    for s, partial_seq in enumerate(partial_seqs):
+        templates[s, : 1 + lengths[s]] = tokenize(alphabet, partial_seq, device)[0]
+    designed_mask = templates == alphabet.get_idx("<mask>")
+
+    # Decoding steps over the designed positions of every structure
+    union = designed_mask.any(dim=0).nonzero().squeeze(-1).tolist()
+    positions = _position_table(model, alphabet, templates.size(1), device)
+    if len(union) == 0:
+        return [
+            templates[s, 1 : 1 + lengths[s]].expand(num_samples, -1) for s in range(S)
+        ]
+
+    # Teacher-force the fixed prefix of every structure once
+    state = DecoderState(encoder_out)
+    prefix_logits = _decode_chunk(
+        model, state, templates[:, : union[0]], positions
+    )[:, -1]
+
+    # Random numbers of each structure, placed at its designed positions
+    uniforms = torch.zeros(num_samples, S, len(union), device=device)
+    union_idx = torch.tensor(union, device=device)
+    for s in range(S):
+        columns = designed_mask[s, union_idx].nonzero().squeeze(-1)
+        uniforms[:, s, columns] = _replicate_uniforms(
+            None if seeds is None else seeds[s], num_samples, columns.size(0)
+        ).to(device)
+
+    # Rows of a block are (replicate, structure) pairs. Blocks hold
+    # batch_size // S replicates (at least one).
+    temps = torch.full((S, 1), temperature, dtype=torch.float32, device=device)
+    block = max(1, batch_size // S)
+    sampled = []
+    for start in range(0, num_samples, block):
+        n = min(block, num_samples - start)
+        rows, _ = _sample_rows(
+            model,
+            state,
+            prefix_logits,
+            templates,
+            designed_mask,
+            union,
+            positions,
+            torch.arange(S, device=device).repeat(n),
+            temps.repeat(n, 1),
+            uniforms[start : start + n].reshape(n * S, -1),
+        )
+        sampled.append(rows)
+
+    # Rows are (replicate, structure) pairs
+    sampled = torch.cat(sampled) if sampled else templates[:0]
+    sampled = sampled.view(num_samples, S, templates.size(1))
+    return [sampled[:, s, 1 : 1 + lengths[s]] for s in range(S)]
@@ -1,266 +1,686 @@
+import logging
 import os
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import esm
 import numpy as np
+import pandas as pd
 import torch
 from esm.inverse_folding.gvp_transformer import GVPTransformerModel
 from esm.data import Alphabet
 
+from .cache import ResultCache
+from .decoding import (
+    encode_structure,
+    encode_structures,
+    sample_distinct,
+    sample_sequences,
+    sample_structures,
+    sample_sweep,
+)
+from .profiling import stage
+from .stats import design_matrix, get_frequency, get_recovery, get_uniqueness
+from .structure import PreparedComplex, prepare_complex
+from .utils import get_replicate_seeds
+
+logger = logging.getLogger(__name__)
+
 # Code based on:
 # https://github.com/facebookresearch/esm/blob/main/examples/inverse_folding/sample_sequences.py
 # https://github.com/facebookresearch/esm/issues/236
 
 
-def _concatenate_multichain_coords(
-    coords: Dict[str, np.ndarray], target_chain_ids: List[str], padding_length: int = 10
-) -> np.ndarray:
-    # Padding coordinates between concatenated chains
+def _crop_around_design(
+    coords: np.ndarray,
+    padding_pattern: List[str],
+    indexes: List[int],
+    chain_sizes: List[int],
+    radius: float,
+    margin: int = 3,
+    padding_length: int = 10,
+) -> Tuple[np.ndarray, List[str], List[int]]:
+    # Nothing to crop around
+    if len(indexes) == 0:
+        return coords, padding_pattern, indexes
+
+    # Residues (not chain padding) of the concatenated complex
+    is_residue = np.array([token != "<pad>" for token in padding_pattern])
+
+    # Keep residues with CA atom within radius of any design residue CA
+    ca = coords[:, 1, :]
+    distances = np.linalg.norm(ca[:, None, :] - ca[None, indexes, :], axis=-1)
+    near = (distances <= radius).any(axis=1)
+    near[indexes] = True
+
+    # Extend kept residues by margin residues along the same chain (chains are
+    # followed by padding_length positions, except the last one)
+    spans = [size + padding_length for size in chain_sizes[:-1]] + chain_sizes[-1:]
+    segment = np.repeat(np.arange(len(chain_sizes)), spans)
+    keep = near.copy()
+    for offset in range(1, margin + 1):
+        same = segment[offset:] == segment[:-offset]
+        keep[offset:] |= near[:-offset] & same
+        keep[:-offset] |= near[offset:] & same
+    keep &= is_residue
+
+    # Concatenate contiguous kept segments separated by padding
     pad_coords = np.full((padding_length, 3, 3), np.nan, dtype=np.float32)
-
-    # For best performance, put the target chains first in concatenation.
-    coords_list = []
-    for chain_id in target_chain_ids:
-        if len(coords_list) > 0:
+    coords_list, cropped_pattern, frame = [], [], []
+    previous = None
+    for index in np.flatnonzero(keep):
+        if previous is not None and index != previous + 1:
             coords_list.append(pad_coords)
-        coords_list.append(coords[chain_id])
-
-    # Concatenate remaining chains
-    for chain_id in coords:
-        if chain_id in target_chain_ids:
-            continue
-        coords_list.append(pad_coords)
-        coords_list.append(coords[chain_id])
-
-    # Concatenate all chains
-    coords_concatenated = np.concatenate(coords_list, axis=0)
+            cropped_pattern.extend(["<pad>"] * padding_length)
+            frame.extend([-1] * padding_length)
+        coords_list.append(coords[index : index + 1])
+        cropped_pattern.append(padding_pattern[index])
+        frame.append(index)
+        previous = index
+    cropped_coords = np.concatenate(coords_list, axis=0)
 
-    return coords_concatenated
+    # Remap design indexes to the cropped complex
+    position = {index: i for i, index in enumerate(frame) if index >= 0}
+    cropped_indexes = [position[index] for index in indexes]
 
+    return cropped_coords, cropped_pattern, cropped_indexes
 
-def _seq2index(
-    structure: np.ndarray, design: List[str], target_chain_ids: List[str]
-) -> List[int]:
-    # Get atoms from design residues
-    atoms = [
-        f"{atom.res_id}{atom.chain_id}"
-        for atom in structure
-        if (atom.chain_id in target_chain_ids) and (atom.atom_name == "CA")
-    ]
 
-    # Get indexes of design residues
-    indexes = [index for index, value in enumerate(atoms) if value in design]
-
-    return indexes
+def _as_prepared(
+    pdbfile: Union[str, PreparedComplex],
+    chains: List[str],
+    design: List[str],
+    padding_length: int = 10,
+) -> PreparedComplex:
+    # Parse structure unless it was already prepared by the caller, in which
+    # case the arguments must describe the same design
+    if isinstance(pdbfile, PreparedComplex):
+        prepared = pdbfile
+        if (
+            list(chains) != prepared.chains
+            or set(design) != set(prepared.design)
+            or padding_length != prepared.padding_length
+        ):
+            raise ValueError(
+                f"Arguments do not match the prepared complex of {prepared.name} "
+                f"(chains {prepared.chains}, {len(prepared.design)} design "
+                f"residues, padding {prepared.padding_length})"
+            )
+        return prepared
+    return prepare_complex(pdbfile, chains, design, padding_length)
 
 
 def prepare_sample_output(
     samples: List[List[str]],
-    pdbfile: str,
+    pdbfile: Union[str, PreparedComplex],
     chains: str,
     design: List[str],
     padding_length: int = 10,
-    basedir: str = "results",
+    basedir: Optional[str] = "results",
 ) -> List[str]:
     # Load structure
-    structure = esm.inverse_folding.util.load_structure(pdbfile)
-    _, native_seqs = esm.inverse_folding.multichain_util.extract_coords_from_complex(
-        structure
+    prepared = _as_prepared(pdbfile, chains, design, padding_length)
+    pdbfile, design, native_seq, indexes = (
+        prepared.pdbfile,
+        prepared.design,
+        prepared.native_seq,
+        prepared.indexes,
     )
 
-    # Get all_coords chain ordering
-    all_coords_chains = chains + list(set(native_seqs.keys()) - set(chains))
-
-    # Get chain sizes
-    chain_sizes = [len(native_seqs[chain_id]) for chain_id in all_coords_chains]
-
-    # Get length of target chain
-    target_chain_len = 0
-    for chain_id, size in zip(all_coords_chains, chain_sizes):
-        if chain_id in chains:
-            target_chain_len += size + padding_length
-
-    # Get native sequence
-    native_seq = []
-    for i, chain_id in enumerate(all_coords_chains):
-        for j in range(chain_sizes[i]):
-            native_seq.append(native_seqs[chain_id][j])
-        if i < len(all_coords_chains) - 1:
-            for j in range(padding_length):
-                native_seq.append("-")
-
-    # Prepare design indexes
-    indexes = []
-    for i, chain_id in enumerate(all_coords_chains):
-        start = sum([chain_sizes[j] for j in range(i)])
-        index = [
-            index + start + (i * padding_length)
-            for index in _seq2index(structure, design, chain_id)
-        ]
-        if len(index) > 0:
-            indexes.extend(index)
+    # Designed residues of each sample
+    designs = ["".join(sample[index] for index in indexes) for sample in samples]
+
+    # Skip writing output when no directory is given
+    if basedir is None:
+        return designs
 
-    designs = []
     outpath = os.path.join(basedir, os.path.basename(pdbfile.replace(".pdb", ".csv")))
-    with open(outpath, "w") as f:
-        for replicate, sample in enumerate(samples):
+    with stage("write", path=outpath, num_samples=len(designs)):
+        with open(outpath, "w") as f:
             n = "".join(native_seq[index] for index in indexes)
-            s = "".join(sample[index] for index in indexes)
-            for i in range(len(s)):
-                f.write(
-                    f"{os.path.basename(pdbfile).replace('.pdb', '')},seq_n{replicate + 1},{design[i][:-1]},{n[i]},{s[i]},{design[i][-1]}\n"
-                )
-            designs.append(s)
+            for replicate, s in enumerate(designs):
+                for i in range(len(s)):
+                    f.write(
+                        f"{os.path.basename(pdbfile).replace('.pdb', '')},seq_n{replicate + 1},{design[i][:-1]},{n[i]},{s[i]},{design[i][-1]}\n"
+                    )
 
     return designs
 
 
+def _stage_fields(prepared: PreparedComplex, model_pattern: List[str]) -> Dict:
+    # Structure, decoded length and number of designed positions of events
+    return {
+        "name": prepared.name,
+        "length": len(model_pattern),
+        "designed": len(prepared.indexes),
+    }
+
+
+def _encode_complex(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    prepared: PreparedComplex,
+    crop_radius: Optional[float] = None,
+    crop_margin: int = 3,
+    verbose: bool = False,
+) -> Tuple[
+    Dict[str, List[torch.Tensor]], List[str], Optional[List[int]], str
+]:
+    # Crop complex to residues around design positions (model_indexes is None
+    # for the full complex)
+    model_coords, model_pattern, model_indexes = (
+        prepared.coords,
+        prepared.padding_pattern,
+        None,
+    )
+    if crop_radius is not None:
+        model_coords, model_pattern, model_indexes = _crop_around_design(
+            prepared.coords,
+            prepared.padding_pattern,
+            prepared.indexes,
+            prepared.chain_sizes,
+            crop_radius,
+            margin=crop_margin,
+            padding_length=prepared.padding_length,
+        )
+        if verbose:
+            logger.info(
+                "> Cropped complex to %d of %d",
+                len(model_pattern),
+                len(prepared.coords),
+            )
+
+    # Encode structure once and reuse it for every sample
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    if verbose:
+        logger.info("> Encoding structure ...")
+    with stage("encode", **_stage_fields(prepared, model_pattern)):
+        encoder_out = encode_structure(model, alphabet, model_coords, device=device)
+
+    return encoder_out, model_pattern, model_indexes, device
+
+
+# Single character of special tokens in sampled sequences
+# <null_0>: 0
+# <null_1>: 1
+# <af2>: 2
+# <cath>: c
+# <cls>: l
+# <mask>: m
+# <eos>: o
+# <unk>: u
+# <pad>: -
+SPECIAL_TOKENS = {
+    "<null_0>": "0",
+    "<null_1>": "1",
+    "<af2>": "2",
+    "<cath>": "c",
+    "<cls>": "l",
+    "<mask>": "m",
+    "<eos>": "o",
+    "<unk>": "u",
+    "<pad>": "-",
+}
+
+
+def _token_table(alphabet: Alphabet) -> np.ndarray:
+    # Character code of every token of the alphabet
+    table = np.full(len(alphabet.all_toks), ord("?"), dtype=np.uint8)
+    for index, token in enumerate(alphabet.all_toks):
+        token = SPECIAL_TOKENS.get(token, token)
+        if len(token) == 1:
+            table[index] = ord(token)
+    return table
+
+
+def _to_codes(
+    tokens: torch.Tensor,
+    alphabet: Alphabet,
+    prepared: PreparedComplex,
+    model_indexes: Optional[List[int]] = None,
+) -> np.ndarray:
+    # Sampled tokens [N, L] as character codes [N, L] through one table lookup
+    codes = _token_table(alphabet)[tokens.cpu().numpy()]
+
+    # Map designed residues of a cropped complex back to the native one
+    if model_indexes is not None:
+        native = design_matrix(["".join(prepared.native_seq)])
+        full = np.repeat(native, len(codes), axis=0)
+        full[:, prepared.indexes] = codes[:, model_indexes]
+        codes = full
+
+    return codes
+
+
+def _to_text(codes: np.ndarray) -> List[str]:
+    # Strings are only built for output
+    return [row.tobytes().decode("ascii") for row in codes]
+
+
+def _recoveries(codes: np.ndarray, prepared: PreparedComplex) -> List[float]:
+    # Fraction of designed positions with the native residue, for all samples
+    # at once
+    native = "".join(prepared.native_seq[index] for index in prepared.indexes)
+    return get_recovery(codes[:, prepared.indexes], native).tolist()
+
+
+def _sample_until_converged(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    encoder_out: Dict[str, List[torch.Tensor]],
+    model_pattern: List[str],
+    prepared: PreparedComplex,
+    model_indexes: Optional[List[int]],
+    block_size: int,
+    max_samples: int,
+    tolerance: float,
+    criterion: str = "frequency",
+    temperature: float = 1.0,
+    batch_size: int = 1,
+    device: str = "cpu",
+    seed: Optional[int] = None,
+) -> Tuple[torch.Tensor, pd.DataFrame]:
+    if block_size < 1:
+        raise ValueError("Adaptive sampling needs at least one sample per block")
+    if criterion not in ("frequency", "uniqueness"):
+        raise ValueError(
+            f"Unknown criterion: {criterion} (use 'frequency' or 'uniqueness')"
+        )
+
+    # Sample blocks until the statistic changes by less than tolerance between
+    # consecutive blocks, or max_samples is reached
+    blocks, designs, trace = [], np.zeros((0, len(prepared.indexes)), np.uint8), []
+    previous = None
+    while len(designs) < max_samples:
+        n = min(block_size, max_samples - len(designs))
+
+        # Seeds continue the replicate stream, so the samples are the same as
+        # a fixed-size run of the final length
+        seeds = None
+        if seed is not None:
+            seeds = get_replicate_seeds(seed, prepared.name, n, start=len(designs))
+        with stage("decode", num_samples=n, **_stage_fields(prepared, model_pattern)):
+            block = sample_sequences(
+                model,
+                alphabet,
+                encoder_out,
+                model_pattern,
+                num_samples=n,
+                temperature=temperature,
+                batch_size=batch_size,
+                device=device,
+                seeds=seeds,
+            )
+        blocks.append(block)
+        codes = _to_codes(block, alphabet, prepared, model_indexes)
+        designs = np.concatenate([designs, codes[:, prepared.indexes]])
+
+        # Frequency per position and uniqueness of all samples so far
+        frequency = np.array(list(get_frequency(designs).values()))
+        uniqueness = get_uniqueness(designs)
+        changes = {"frequency_change": np.nan, "uniqueness_change": np.nan}
+        if previous is not None:
+            changes["frequency_change"] = (
+                np.abs(frequency - previous[0]).max() if frequency.size else 0.0
+            )
+            changes["uniqueness_change"] = abs(uniqueness - previous[1])
+        trace.append({"samples": len(designs), "uniqueness": uniqueness, **changes})
+        previous = (frequency, uniqueness)
+
+        if changes[f"{criterion}_change"] < tolerance:
+            break
+
+    return torch.cat(blocks), pd.DataFrame(trace)
+
+
 def sample_seq_multichain(
     model: GVPTransformerModel,
     alphabet: Alphabet,
-    pdbfile: str,
+    pdbfile: Union[str, PreparedComplex],
     chains: str,
     design: List[str],
-    outpath: str,
+    outpath: Optional[str],
     num_samples: int = 1,
     temperature: float = 1.0,
     padding_length: int = 10,
     verbose: bool = False,
+    batch_size: int = 1,
+    crop_radius: Optional[float] = None,
+    crop_margin: int = 3,
+    seed: Optional[int] = None,
+    tolerance: Optional[float] = None,
+    max_samples: int = 500,
+    criterion: str = "frequency",
+    unique: bool = False,
+    cache: Optional[ResultCache] = None,
+    trace_dir: Optional[str] = None,
 ) -> Tuple[List[str], List[float]]:
     # Transfer model to GPU if available
     if torch.cuda.is_available():
         if verbose:
-            print("> Transferring model to GPU ...")
+            logger.info("> Transferring model to GPU ...")
         model = model.cuda()
 
     # Load structure
-    structure = esm.inverse_folding.util.load_structure(pdbfile)
-    coords, native_seqs = (
-        esm.inverse_folding.multichain_util.extract_coords_from_complex(structure)
-    )
-
-    # Prepare input for sampling
-    all_coords = _concatenate_multichain_coords(
-        coords, chains, padding_length=padding_length
-    )
-
-    # Get all_coords chain ordering
-    all_coords_chains = chains + list(set(native_seqs.keys()) - set(chains))
-
-    # Get chain sizes
-    chain_sizes = [len(native_seqs[chain_id]) for chain_id in all_coords_chains]
-
-    # Get length of target chain
-    target_chain_len = 0
-    for chain_id, size in zip(all_coords_chains, chain_sizes):
-        if chain_id in chains:
-            target_chain_len += size + padding_length
-
-    # Get native sequence
-    native_seq = []
-    for i, chain_id in enumerate(all_coords_chains):
-        for j in range(chain_sizes[i]):
-            native_seq.append(native_seqs[chain_id][j])
-        if i < len(all_coords_chains) - 1:
-            for j in range(padding_length):
-                native_seq.append("-")
-
-    # Prepare design indexes
-    indexes = []
-    for i, chain_id in enumerate(all_coords_chains):
-        start = sum([chain_sizes[j] for j in range(i)])
-        index = [
-            index + start + (i * padding_length)
-            for index in _seq2index(structure, design, chain_id)
-        ]
-        if len(index) > 0:
-            indexes.extend(index)
-
-    # Supply padding tokens for other chains to avoid unused sampling for speed
-    # <res_name> for fixed residues
-    # <mask> for designed residues
-    # <pad> to ignore other chains
-    padding_pattern = []
-    for i, chain_id in enumerate(all_coords_chains):
-        for j in range(chain_sizes[i]):
-            padding_pattern.append(native_seqs[chain_id][j])
-        if i < len(all_coords_chains) - 1:
-            for j in range(padding_length):
-                padding_pattern.append("<pad>")
-    for index in indexes:
-        padding_pattern[index] = "<mask>"
-
-    # Send coordinates to gpu
-    if torch.cuda.is_available():
-        if verbose:
-            print("> Transferring data to GPU ...")
-        all_coords = torch.from_numpy(all_coords).to("cuda:0")
+    prepared = _as_prepared(pdbfile, chains, design, padding_length)
+    native_seq, indexes = prepared.native_seq, prepared.indexes
 
     # Sampling sequences with design residues
     samples, recoveries = [], []
 
-    for i in range(num_samples):
-        print(f"\n> Sampling.. ({i+1} of {num_samples})")
-        sampled = model.sample(
-            all_coords,
-            partial_seq=padding_pattern,
-            temperature=temperature,
-            device="cuda:0" if torch.cuda.is_available else "cpu",
+    if unique and tolerance is not None:
+        raise ValueError("Unique and adaptive sampling cannot be combined")
+
+    # Samples of the same seeded run stored in the result cache are reused, and
+    # only the missing replicates are sampled
+    cache_key = None
+    if cache is not None and seed is not None and tolerance is None and not unique:
+        cache_key = cache.key(
+            model, prepared, temperature, seed, crop_radius, crop_margin
         )
-        # Replace unwanted tokens to design
-        # <null_0>: 0
-        # <null_1>: 1
-        # <af2>: 2
-        # <cath>: c
-        # <cls>: l
-        # <mask>: m
-        # <eos>: o
-        # <unk>: u
-        # <pad>: -
-        sampled = (
-            sampled.replace("<null_0>", "0")
-            .replace("<null_1>", "1")
-            .replace("<af2>", "2")
-            .replace("<cath>", "c")
-            .replace("<cls>", "l")
-            .replace("<eos>", "o")
-            .replace("<mask>", "m")
-            .replace("<unk>", "u")
-            .replace("<pad>", "-")
+        cached = cache.get(cache_key)
+        if cached is not None:
+            samples, recoveries = cached[0][:num_samples], cached[1][:num_samples]
+            logger.info("\n> Reusing %d cached samples", len(samples))
+    start = len(samples)
+
+    # Crop and encode complex (unless every sample is cached)
+    if start < num_samples or unique or tolerance is not None:
+        encoder_out, model_pattern, model_indexes, device = _encode_complex(
+            model, alphabet, prepared, crop_radius, crop_margin, verbose
         )
 
-        if verbose:
-            print(f"> Sampled sequence {i+1}:")
-            print(sampled)
-            print("".join(padding_pattern).replace("<mask>", "X").replace("<pad>", "-"))
-
-        # Append samples sequence to list
-        samples.append(sampled[:target_chain_len])
-
-        # Sequence recovery
-        recovery = np.mean(
-            [
-                (a == b)
-                for a, b in zip(
-                    "".join(native_seq[index] for index in indexes),
-                    "".join(samples[i][index] for index in indexes),
-                )
-            ]
+    if unique:
+        # Sample until num_samples distinct designs are found (up to
+        # max_samples draws), rejecting designs already seen
+        seeds = None
+        if seed is not None:
+            seeds = get_replicate_seeds(seed, prepared.name, max_samples)
+        logger.info(
+            "\n> Sampling.. (%d distinct samples up to %d, batch size %d)",
+            num_samples,
+            max_samples,
+            batch_size,
+        )
+        with stage("decode", **_stage_fields(prepared, model_pattern)) as event:
+            sampled_tokens, drawn, passes = sample_distinct(
+                model,
+                alphabet,
+                encoder_out,
+                model_pattern,
+                num_samples,
+                temperature=temperature,
+                batch_size=batch_size,
+                device=device,
+                seeds=seeds,
+                max_samples=max_samples,
+            )
+            event.update(num_samples=drawn, passes=passes)
+        logger.info(
+            "> %d distinct samples from %d draws (%d decoder passes)",
+            len(sampled_tokens),
+            drawn,
+            passes,
         )
-        recoveries.append(recovery)
-        print(f"Native sequence: {''.join(native_seq[index] for index in indexes)}")
-        print(f"Designed sequence: {''.join(samples[i][index] for index in indexes)}")
-        print("Sequence recovery:", recovery)
+    elif start == num_samples:
+        sampled_tokens = None
+    elif tolerance is None:
+        # Per-replicate seeds make samples independent of batching and workers
+        seeds = None
+        if seed is not None:
+            seeds = get_replicate_seeds(
+                seed, prepared.name, num_samples - start, start=start
+            )
+
+        # Decode up to batch_size samples in parallel
+        logger.info(
+            "\n> Sampling.. (%d samples, batch size %d)",
+            num_samples - start,
+            batch_size,
+        )
+        with stage(
+            "decode",
+            num_samples=num_samples - start,
+            **_stage_fields(prepared, model_pattern),
+        ):
+            sampled_tokens = sample_sequences(
+                model,
+                alphabet,
+                encoder_out,
+                model_pattern,
+                num_samples=num_samples - start,
+                temperature=temperature,
+                batch_size=batch_size,
+                device=device,
+                seeds=seeds,
+            )
+    else:
+        # Adaptive sampling in blocks of num_samples until the frequencies (or
+        # uniqueness) converge
+        logger.info(
+            "\n> Sampling.. (blocks of %d samples up to %d, %s tolerance %s)",
+            num_samples,
+            max_samples,
+            criterion,
+            tolerance,
+        )
+        sampled_tokens, trace = _sample_until_converged(
+            model,
+            alphabet,
+            encoder_out,
+            model_pattern,
+            prepared,
+            model_indexes,
+            num_samples,
+            max_samples,
+            tolerance,
+            criterion,
+            temperature,
+            batch_size,
+            device,
+            seed,
+        )
+        logger.info("> Stopped after %d samples", len(sampled_tokens))
+        logger.info("%s", trace)
+
+        # Save convergence trace in trace_dir (or next to the samples)
+        tracepath = None
+        if trace_dir is not None:
+            tracepath = os.path.join(trace_dir, f"{prepared.name}_convergence.csv")
+        elif outpath is not None:
+            tracepath = os.path.splitext(outpath)[0] + "_convergence.csv"
+        if tracepath is not None:
+            Path(tracepath).parent.mkdir(parents=True, exist_ok=True)
+            trace.to_csv(tracepath, index=False)
+        else:
+            logger.warning("Convergence trace of %s not saved", prepared.name)
+
+    if sampled_tokens is not None:
+        # Character codes of the new samples
+        codes = _to_codes(sampled_tokens, alphabet, prepared, model_indexes)
+        if verbose:
+            pattern = (
+                "".join(prepared.padding_pattern)
+                .replace("<mask>", "X")
+                .replace("<pad>", "-")
+            )
+            for i, sampled in enumerate(_to_text(codes), start=start):
+                logger.info("> Sampled sequence %d:\n%s\n%s", i + 1, sampled, pattern)
+        codes = codes[:, : prepared.target_len]
+
+        # Sequence recovery of all new samples
+        with stage(
+            "recovery",
+            name=prepared.name,
+            num_samples=len(codes),
+            designed=len(indexes),
+        ):
+            new_recoveries = _recoveries(codes, prepared)
+        if logger.isEnabledFor(logging.DEBUG):
+            native = "".join(native_seq[index] for index in indexes)
+            for design, recovery in zip(_to_text(codes[:, indexes]), new_recoveries):
+                logger.debug("Native sequence: %s", native)
+                logger.debug("Designed sequence: %s", design)
+                logger.debug("Sequence recovery: %s", recovery)
+        samples += _to_text(codes)
+        recoveries += new_recoveries
+
+        # Store (or extend) the cache entry
+        if cache_key is not None:
+            cache.put(cache_key, samples, recoveries)
 
     # Save sampled sequences to file
-    print(f"\n> Saving sampled sequences to {outpath}.")
-    Path(outpath).parent.mkdir(parents=True, exist_ok=True)
-    with open(outpath, "w") as f:
-        f.write(">native_seq\n")
-        f.write("".join(native_seq) + "\n")
-        for i in range(num_samples):
-            f.write(f">sampled_seq_{i+1}\n")
-            f.write(samples[i] + "\n")
+    if outpath is not None:
+        logger.info("\n> Saving sampled sequences to %s.", outpath)
+        write_fasta(outpath, native_seq, samples)
 
     return samples, recoveries
+
+
+def sample_temperature_sweep(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    pdbfile: Union[str, PreparedComplex],
+    chains: str,
+    design: List[str],
+    temperatures: List[float],
+    num_samples: int = 1,
+    padding_length: int = 10,
+    batch_size: int = 1,
+    crop_radius: Optional[float] = None,
+    crop_margin: int = 3,
+    seed: Optional[int] = None,
+) -> pd.DataFrame:
+    # Transfer model to GPU if available
+    if torch.cuda.is_available():
+        model = model.cuda()
+
+    # Structure is parsed and encoded once for every temperature
+    prepared = _as_prepared(pdbfile, chains, design, padding_length)
+    encoder_out, model_pattern, model_indexes, device = _encode_complex(
+        model, alphabet, prepared, crop_radius, crop_margin
+    )
+
+    # Same per-replicate seeds as sample_seq_multichain, so every temperature
+    # matches a single-temperature run with the same seed
+    seeds = None
+    if seed is not None:
+        seeds = get_replicate_seeds(seed, prepared.name, num_samples)
+
+    # Decode all temperatures together, sharing logits between them
+    logger.info(
+        "\n> Sampling.. (%d samples x %d temperatures, batch size %d)",
+        num_samples,
+        len(temperatures),
+        batch_size,
+    )
+    with stage(
+        "decode",
+        num_samples=num_samples * len(temperatures),
+        **_stage_fields(prepared, model_pattern),
+    ):
+        sweep = sample_sweep(
+            model,
+            alphabet,
+            encoder_out,
+            model_pattern,
+            temperatures,
+            num_samples=num_samples,
+            batch_size=batch_size,
+            device=device,
+            seeds=seeds,
+        )
+
+    # One row per temperature and replicate
+    tables = []
+    for temperature, sampled_tokens in zip(temperatures, sweep):
+        codes = _to_codes(sampled_tokens, alphabet, prepared, model_indexes)
+        codes = codes[:, : prepared.target_len]
+        tables.append(
+            pd.DataFrame(
+                {
+                    "temperature": temperature,
+                    "replicate": np.arange(1, len(codes) + 1),
+                    "sample": _to_text(codes),
+                    "design": _to_text(codes[:, prepared.indexes]),
+                    "recovery": _recoveries(codes, prepared),
+                },
+                columns=["temperature", "replicate", "sample", "design", "recovery"],
+            )
+        )
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def sample_seq_batch(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    prepared: List[PreparedComplex],
+    num_samples: int = 1,
+    temperature: float = 1.0,
+    batch_size: int = 1,
+    seed: Optional[int] = None,
+) -> List[Tuple[List[str], List[float]]]:
+    # Transfer model to GPU if available
+    if torch.cuda.is_available():
+        model = model.cuda()
+
+    # Encode all structures in one padded batch
+    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    encoder_out = encode_structures(
+        model, alphabet, [structure.coords for structure in prepared], device=device
+    )
+
+    # Per-replicate seeds of each structure, as in sample_seq_multichain
+    seeds = None
+    if seed is not None:
+        seeds = [
+            get_replicate_seeds(seed, structure.name, num_samples)
+            for structure in prepared
+        ]
+
+    # Decode all structures together
+    logger.info(
+        "\n> Sampling.. (%d structures x %d samples, batch size %d)",
+        len(prepared),
+        num_samples,
+        batch_size,
+    )
+    with stage(
+        "decode",
+        name=",".join(structure.name for structure in prepared),
+        length=max(len(structure.padding_pattern) for structure in prepared),
+        designed=sum(len(structure.indexes) for structure in prepared),
+        num_samples=num_samples * len(prepared),
+    ):
+        sampled_tokens = sample_structures(
+            model,
+            alphabet,
+            encoder_out,
+            [structure.padding_pattern for structure in prepared],
+            num_samples=num_samples,
+            temperature=temperature,
+            batch_size=batch_size,
+            device=device,
+            seeds=seeds,
+        )
+
+    # Split samples and recoveries back per structure
+    results = []
+    for structure, tokens in zip(prepared, sampled_tokens):
+        codes = _to_codes(tokens, alphabet, structure)
+        codes = codes[:, : structure.target_len]
+        results.append((_to_text(codes), _recoveries(codes, structure)))
+
+    return results
+
+
+def write_fasta(outpath: str, native_seq: List[str], samples: List[str]) -> None:
+    Path(outpath).parent.mkdir(parents=True, exist_ok=True)
+    with stage("write", path=outpath, num_samples=len(samples)):
+        with open(outpath, "w") as f:
+            f.write(">native_seq\n")
+            f.write("".join(native_seq) + "\n")
+            for i in range(len(samples)):
+                f.write(f">sampled_seq_{i+1}\n")
+                f.write(samples[i] + "\n")
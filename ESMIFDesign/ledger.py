@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Persistent ledger of completed design units, so interrupted runs can skip
+# finished work. A unit is one sampling call, keyed by (scope, pdb, design set,
+# temperature, num_samples, seed, settings, digest). The scope (e.g. the output
+# directory) separates experiments that sample the same structure with the same
+# settings. Settings hold everything else that changes the designs of a unit
+# (e.g. padding, precision and model fingerprint, see DesignSettings.fingerprint)
+# and digest is the SHA-256 of the structure file (see pdb_digest), so an
+# edited structure is sampled again.
+
+
+class DesignLedger:
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS units (
+                key TEXT PRIMARY KEY,
+                scope TEXT,
+                pdb TEXT,
+                design TEXT,
+                temperature REAL,
+                num_samples INTEGER,
+                seed INTEGER,
+                designs TEXT,
+                recoveries TEXT,
+                completed REAL
+            )
+            """
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def _key(
+        scope: str,
+        pdb: str,
+        design: List[str],
+        temperature: float,
+        num_samples: int,
+        seed: Optional[int],
+        settings: Optional[Dict[str, Any]],
+        digest: Optional[str],
+    ) -> str:
+        # Design residues are a set: their order does not change the unit
+        unit = [
+            scope,
+            pdb,
+            sorted(design),
+            float(temperature),
+            num_samples,
+            seed,
+            settings or {},
+            digest,
+        ]
+        return hashlib.sha256(json.dumps(unit, sort_keys=True).encode()).hexdigest()
+
+    def get(
+        self,
+        pdb: str,
+        design: List[str],
+        temperature: float,
+        num_samples: int,
+        seed: Optional[int] = None,
+        scope: str = "",
+        settings: Optional[Dict[str, Any]] = None,
+        digest: Optional[str] = None,
+    ) -> Optional[Tuple[List[str], List[float]]]:
+        # Designs and recoveries of a completed unit, or None
+        key = self._key(
+            scope, pdb, design, temperature, num_samples, seed, settings, digest
+        )
+        row = self._connection.execute(
+            "SELECT designs, recoveries FROM units WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def record(
+        self,
+        pdb: str,
+        design: List[str],
+        temperature: float,
+        num_samples: int,
+        seed: Optional[int],
+        designs: List[str],
+        recoveries: List[float],
+        scope: str = "",
+        settings: Optional[Dict[str, Any]] = None,
+        digest: Optional[str] = None,
+    ) -> None:
+        # Store a completed unit, committed immediately so it survives a crash
+        key = self._key(
+            scope, pdb, design, temperature, num_samples, seed, settings, digest
+        )
+        self._connection.execute(
+            "INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                scope,
+                pdb,
+                json.dumps(list(design)),
+                float(temperature),
+                num_samples,
+                seed,
+                json.dumps(list(designs)),
+                json.dumps([float(recovery) for recovery in recoveries]),
+                time.time(),
+            ),
+        )
+        self._connection.commit()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __enter__(self) -> "DesignLedger":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
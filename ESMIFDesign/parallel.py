@@ -0,0 +1,257 @@
+import logging
+import multiprocessing
+import os
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import torch
+from esm.data import Alphabet
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+
+from .cache import ResultCache, _model_id
+from .esmif import (
+    prepare_sample_output,
+    sample_seq_batch,
+    sample_seq_multichain,
+    write_fasta,
+)
+from .precision import get_precision
+from .structure import prepare_complex
+from .utils import get_chains
+
+logger = logging.getLogger(__name__)
+
+# Model shared with forked workers (copy-on-write). Set by run_parallel before
+# the pool is created, so workers never receive a pickled copy.
+_model: Optional[GVPTransformerModel] = None
+_alphabet: Optional[Alphabet] = None
+
+
+@dataclass
+class DesignTask:
+    pdb: str
+    pdbfile: str
+    design: List[str]
+    outpath: Optional[str]
+    basedir: Optional[str]
+
+
+@dataclass
+class DesignSettings:
+    num_samples: int = 1
+    temperature: float = 1.0
+    padding_length: int = 10
+    batch_size: int = 1
+    seed: int = 0
+    cache_dir: Optional[str] = None
+    # Adaptive sampling in blocks of num_samples (see sample_seq_multichain)
+    tolerance: Optional[float] = None
+    max_samples: int = 500
+    # Sample num_samples distinct designs (up to max_samples draws)
+    unique: bool = False
+    # Directory of the result cache (see ResultCache)
+    result_cache: Optional[str] = None
+    # Directory of convergence traces of adaptive sampling (default: basedir of
+    # each task)
+    trace_dir: Optional[str] = None
+
+    def fingerprint(self, model: GVPTransformerModel) -> Dict[str, Any]:
+        # Settings that change the designs (see DesignLedger). Batch size and
+        # directories only change how designs are computed or where they go.
+        settings = asdict(self)
+        for key in ("batch_size", "cache_dir", "result_cache", "trace_dir"):
+            del settings[key]
+        settings["precision"] = get_precision(model)
+        settings["model"] = _model_id(model)
+        return settings
+
+
+def _init_worker(num_threads: int) -> None:
+    # Limit intra-op threads so workers do not oversubscribe the cores
+    torch.set_num_threads(num_threads)
+
+
+def _run_task(
+    args: Tuple[DesignTask, DesignSettings]
+) -> Tuple[str, List[str], List[float]]:
+    task, settings = args
+    chains = get_chains(task.design)
+
+    # Parse structure once for sampling and output
+    prepared = prepare_complex(
+        task.pdbfile, chains, task.design, settings.padding_length, settings.cache_dir
+    )
+
+    # Sampling sequences (seeded per replicate)
+    samples, recoveries = sample_seq_multichain(
+        _model,
+        _alphabet,
+        prepared,
+        chains,
+        task.design,
+        task.outpath,
+        settings.num_samples,
+        settings.temperature,
+        settings.padding_length,
+        False,
+        settings.batch_size,
+        seed=settings.seed,
+        tolerance=settings.tolerance,
+        max_samples=settings.max_samples,
+        unique=settings.unique,
+        cache=(
+            None
+            if settings.result_cache is None
+            else ResultCache(settings.result_cache)
+        ),
+        trace_dir=settings.trace_dir or task.basedir,
+    )
+
+    # Save samples
+    designs = prepare_sample_output(
+        samples, prepared, chains, task.design, settings.padding_length, task.basedir
+    )
+
+    return task.pdb, designs, recoveries
+
+
+def run_parallel(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    tasks: List[DesignTask],
+    settings: DesignSettings,
+    workers: int = 1,
+    threads_per_worker: Optional[int] = None,
+    on_result: Optional[Callable[[str, List[str], List[float]], None]] = None,
+) -> Dict[str, Tuple[List[str], List[float]]]:
+    global _model, _alphabet
+
+    # Split available cores between workers
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // workers)
+
+    # Fork workers after the model is loaded but before it is used, so
+    # weights are shared and no OpenMP state is inherited
+    _model, _alphabet = model, alphabet
+    context = multiprocessing.get_context("fork")
+    results = {}
+    with context.Pool(
+        workers, initializer=_init_worker, initargs=(threads_per_worker,)
+    ) as pool:
+        for pdb, designs, recoveries in pool.imap_unordered(
+            _run_task, [(task, settings) for task in tasks]
+        ):
+            logger.info("[==> %s done", pdb)
+            results[pdb] = (designs, recoveries)
+
+            # Report each result as soon as it completes (e.g. to a ledger)
+            if on_result is not None:
+                on_result(pdb, designs, recoveries)
+
+    # Results in task order, whatever the completion order
+    return {task.pdb: results[task.pdb] for task in tasks}
+
+
+def bucket_by_length(
+    lengths: List[int], max_structures: int = 8, max_padding: float = 0.1
+) -> List[List[int]]:
+    # Group indexes of structures of similar length. Structures are taken by
+    # increasing length and a bucket is closed when it holds max_structures or
+    # when padding its shortest structure would exceed max_padding of the
+    # longest one.
+    buckets = []
+    for index in sorted(range(len(lengths)), key=lambda index: lengths[index]):
+        if (
+            len(buckets) > 0
+            and len(buckets[-1]) < max_structures
+            and lengths[index] - lengths[buckets[-1][0]] <= max_padding * lengths[index]
+        ):
+            buckets[-1].append(index)
+        else:
+            buckets.append([index])
+    return buckets
+
+
+def run_batched(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    tasks: List[DesignTask],
+    settings: DesignSettings,
+    max_structures: int = 8,
+    max_padding: float = 0.1,
+    on_result: Optional[Callable[[str, List[str], List[float]], None]] = None,
+) -> Dict[str, Tuple[List[str], List[float]]]:
+    # Convergence traces (settings.trace_dir) only exist for adaptive sampling
+    if settings.tolerance is not None or settings.unique:
+        raise ValueError("Batched structures only support a fixed number of samples")
+
+    # Parse every structure
+    prepared = [
+        prepare_complex(
+            task.pdbfile,
+            get_chains(task.design),
+            task.design,
+            settings.padding_length,
+            settings.cache_dir,
+        )
+        for task in tasks
+    ]
+
+    results = {}
+
+    def finish(index: int, samples: List[str], recoveries: List[float]) -> None:
+        task, structure = tasks[index], prepared[index]
+        if task.outpath is not None:
+            write_fasta(task.outpath, structure.native_seq, samples)
+        designs = prepare_sample_output(
+            samples,
+            structure,
+            structure.chains,
+            structure.design,
+            settings.padding_length,
+            task.basedir,
+        )
+        results[task.pdb] = (designs, recoveries)
+        if on_result is not None:
+            on_result(task.pdb, designs, recoveries)
+
+    # Seeded samples stored in the result cache are reused, as in
+    # sample_seq_multichain (entries are interchangeable)
+    cache, keys, pending = None, {}, list(range(len(tasks)))
+    if settings.result_cache is not None and settings.seed is not None:
+        cache, pending = ResultCache(settings.result_cache), []
+        n = settings.num_samples
+        for index, structure in enumerate(prepared):
+            keys[index] = cache.key(
+                model, structure, settings.temperature, settings.seed
+            )
+            cached = cache.get(keys[index])
+            if cached is not None and len(cached[0]) >= n:
+                logger.info("[==> %s (cached)", tasks[index].pdb)
+                finish(index, cached[0][:n], cached[1][:n])
+            else:
+                pending.append(index)
+
+    # Encode and decode structures of similar length together
+    lengths = [len(prepared[index].padding_pattern) for index in pending]
+    for bucket in bucket_by_length(lengths, max_structures, max_padding):
+        bucket = [pending[position] for position in bucket]
+        logger.info("[==> %s", ", ".join(tasks[index].pdb for index in bucket))
+        outputs = sample_seq_batch(
+            model,
+            alphabet,
+            [prepared[index] for index in bucket],
+            settings.num_samples,
+            settings.temperature,
+            settings.batch_size,
+            settings.seed,
+        )
+
+        # Split results back per structure
+        for index, (samples, recoveries) in zip(bucket, outputs):
+            if cache is not None:
+                cache.put(keys[index], samples, recoveries)
+            finish(index, samples, recoveries)
+
+    # Results in task order, whatever the bucket order
+    return {task.pdb: results[task.pdb] for task in tasks}
@@ -0,0 +1,72 @@
+import contextlib
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+
+logger = logging.getLogger(__name__)
+
+# Reduced precision modes of the loaded model for CPU inference:
+# fp32: full precision (reference)
+# int8: dynamic int8 quantization of the linear layers of the transformer
+# (weights stored as int8, activations quantized on the fly)
+# bf16: bfloat16 autocast of the encoder and decoder (weights kept in fp32)
+# Logits are always converted to fp32 before softmax.
+PRECISIONS = ("fp32", "int8", "bf16")
+
+
+def get_precision(model: GVPTransformerModel) -> str:
+    return getattr(model, "precision", "fp32")
+
+
+def set_precision(model: GVPTransformerModel, precision: str) -> GVPTransformerModel:
+    # Return a model running in the given precision. The fp32 model is left
+    # untouched, so both can be compared (see scoring.check_precision).
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Unknown precision: {precision} (use {', '.join(PRECISIONS)})"
+        )
+    if get_precision(model) != "fp32":
+        raise ValueError("Precision modes apply to an fp32 model")
+
+    if precision == "int8":
+        # Quantized kernels only run on CPU, while sampling moves the model to
+        # the GPU when one is available
+        if torch.cuda.is_available():
+            raise ValueError("int8 precision is only supported on CPU")
+
+        # Without fbgemm (e.g. on ARM), the process-wide quantized engine is
+        # switched to qnnpack, which also affects other quantized models
+        if "fbgemm" not in torch.backends.quantized.supported_engines:
+            logger.info("> Setting the quantized engine to qnnpack")
+            torch.backends.quantized.engine = "qnnpack"
+        model = copy.deepcopy(model).cpu()
+
+        # Encoder self-attention runs through a fused kernel that reads the
+        # projection weights directly, so only its feed-forward layers are
+        # quantized. Decoder attention runs projection by projection
+        # (incremental state), so all of its linear layers are.
+        for layer in model.encoder.layers:
+            torch.quantization.quantize_dynamic(
+                layer, {"fc1", "fc2"}, dtype=torch.qint8, inplace=True
+            )
+        for layer in model.decoder.layers:
+            torch.quantization.quantize_dynamic(
+                layer, {nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+    else:
+        # Weights are shared with the fp32 model
+        model = copy.copy(model)
+
+    model.precision = precision
+    return model
+
+
+def autocast(model: GVPTransformerModel):
+    # bf16 autocast context of a model set to "bf16" (no-op otherwise)
+    if get_precision(model) != "bf16":
+        return contextlib.nullcontext()
+    device_type = next(model.parameters()).device.type
+    return torch.autocast(device_type, dtype=torch.bfloat16)
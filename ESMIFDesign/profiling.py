@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import resource
+import time
+from typing import Any, Callable, Dict, List
+
+# Stage-level timing events (load, prepare, encode, decode, recovery, write).
+# Every stage emits one event with its duration, the structure it ran on and
+# the peak memory of the process to the registered sinks. Without sinks, stage
+# returns a shared no-op context and nothing is measured.
+
+Event = Dict[str, Any]
+
+_sinks: List[Callable[[Event], None]] = []
+
+
+def add_sink(sink: Callable[[Event], None]) -> None:
+    _sinks.append(sink)
+
+
+def remove_sink(sink: Callable[[Event], None]) -> None:
+    _sinks.remove(sink)
+
+
+def clear_sinks() -> None:
+    _sinks.clear()
+
+
+def profiling_enabled() -> bool:
+    return len(_sinks) > 0
+
+
+def _emit(event: Event) -> None:
+    for sink in _sinks:
+        sink(event)
+
+
+class _Stage:
+    __slots__ = ("event", "start")
+
+    def __init__(self, stage_name: str, fields: Event):
+        self.event = {"stage": stage_name, **fields}
+
+    def __enter__(self) -> Event:
+        self.start = time.perf_counter()
+        return self.event
+
+    def __exit__(self, *args) -> None:
+        self.event["duration"] = time.perf_counter() - self.start
+        # ru_maxrss is in KiB on Linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.event["peak_rss_mb"] = rss / 1024
+        self.event["pid"] = os.getpid()
+        self.event["time"] = time.time()
+        _emit(self.event)
+
+
+class _NullStage:
+    __slots__ = ()
+
+    def __enter__(self) -> Event:
+        return {}
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(stage_name: str, **fields: Any):
+    # Time the enclosed block. Fields known only inside the block can be added
+    # to the returned event, e.g.:
+    # with stage("decode", name=prepared.name) as event:
+    #     event["num_samples"] = ...
+    if not _sinks:
+        return _NULL_STAGE
+    return _Stage(stage_name, fields)
+
+
+class JsonLinesSink:
+    # Append one JSON object per event. Each event is written with a single
+    # write on a file opened for appending, so forked workers can share it.
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def __call__(self, event: Event) -> None:
+        os.write(self._fd, (json.dumps(event) + "\n").encode())
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+class LoggingSink:
+    # Log events as a one-line summary
+    def __init__(self, logger: logging.Logger, level: int = logging.DEBUG):
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, event: Event) -> None:
+        if self.logger.isEnabledFor(self.level):
+            fields = " ".join(
+                f"{key}={value}"
+                for key, value in event.items()
+                if key not in ("stage", "duration", "time", "pid")
+            )
+            self.logger.log(
+                self.level,
+                "[%s] %.4f s %s",
+                event["stage"],
+                event["duration"],
+                fields,
+            )
@@ -0,0 +1,240 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from esm.data import Alphabet
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+
+from .decoding import (
+    encode_structure,
+    forward_logits,
+    sample_sequences,
+    scan_tokens,
+    score_tokens,
+    tokenize,
+)
+from .esmif import _recoveries, _to_codes
+from .precision import set_precision
+from .stats import AMINO_ACIDS
+from .structure import PreparedComplex
+from .utils import get_replicate_seeds
+
+
+def _model_device(model: GVPTransformerModel) -> str:
+    return str(next(model.parameters()).device)
+
+
+def _native_pattern(prepared: PreparedComplex) -> List[str]:
+    # Padding pattern with native residues at designed positions
+    return [
+        token if token != "<mask>" else prepared.native_seq[index]
+        for index, token in enumerate(prepared.padding_pattern)
+    ]
+
+
+def get_residue_probabilities(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    prepared: PreparedComplex,
+    temperature: float = 1.0,
+    mode: str = "masked_context",
+) -> Dict[str, List[float]]:
+    # Context of designed positions:
+    # masked_context: earlier designed positions are fed to the decoder as
+    # <mask>. The decoder never sees <mask> as input in training or sampling, so
+    # this is an approximation, not the marginal over sampled contexts.
+    # conditional: native residues at designed positions (chain rule given
+    # the native sequence)
+    if mode == "masked_context":
+        partial_seq = prepared.padding_pattern
+    elif mode == "conditional":
+        partial_seq = _native_pattern(prepared)
+    else:
+        raise ValueError(
+            f"Unknown mode: {mode} (use 'masked_context' or 'conditional')"
+        )
+
+    # Nothing to predict without designed positions
+    if len(prepared.indexes) == 0:
+        return {aa: [] for aa in AMINO_ACIDS}
+
+    # One teacher-forced pass over the complex
+    device = _model_device(model)
+    encoder_out = encode_structure(model, alphabet, prepared.coords, device=device)
+    tokens = tokenize(alphabet, partial_seq, device)
+    targets = [index + 1 for index in prepared.indexes]
+    logits = forward_logits(model, alphabet, encoder_out, tokens, targets)[0]
+
+    # Sampling distribution at each designed position, in the same layout as
+    # get_frequency_of_residues (special tokens are left out, not renormalized)
+    probs = F.softmax(logits.float() / temperature, dim=-1).cpu()
+    frequency = {}
+    for aa in AMINO_ACIDS:
+        frequency[aa] = probs[:, alphabet.get_idx(aa)].tolist()
+
+    return frequency
+
+
+def _candidate_tokens(alphabet: Alphabet, candidates: List[str]) -> torch.Tensor:
+    # Convert equal-length one-letter candidates to alphabet indices through a
+    # byte lookup table, without a Python loop over candidates
+    lengths = set(map(len, candidates))
+    if len(lengths) != 1:
+        raise ValueError("Candidates must all have the same length")
+    lut = np.full(256, -1, dtype=np.int64)
+    for aa in AMINO_ACIDS:
+        lut[ord(aa)] = alphabet.get_idx(aa)
+    encoded = np.frombuffer("".join(candidates).encode("ascii"), dtype=np.uint8)
+    tokens = lut[encoded].reshape(len(candidates), lengths.pop())
+    if (tokens < 0).any():
+        raise ValueError("Candidates must only contain the 20 standard amino acids")
+    return torch.from_numpy(tokens)
+
+
+def score_sequences(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    prepared: PreparedComplex,
+    candidates: List[str],
+    batch_size: int = 32,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Candidates give the residues at the designed positions, in the order of
+    # prepared.design (the same strings as returned by prepare_sample_output)
+    if len(candidates) == 0 or len(prepared.indexes) == 0:
+        logp = np.zeros((len(candidates), len(prepared.indexes)), dtype=np.float32)
+        return logp.sum(axis=1), logp
+    tokens = _candidate_tokens(alphabet, candidates)
+    if tokens.size(1) != len(prepared.indexes):
+        raise ValueError(
+            f"Candidates have {tokens.size(1)} residues, "
+            f"expected {len(prepared.indexes)} designed positions"
+        )
+
+    # Shared encoder pass and template with every other residue fixed
+    device = _model_device(model)
+    encoder_out = encode_structure(model, alphabet, prepared.coords, device=device)
+    template = tokenize(alphabet, prepared.padding_pattern, device)
+    targets = [index + 1 for index in prepared.indexes]
+
+    # Per-position and per-sequence log-likelihoods
+    logp = score_tokens(
+        model, alphabet, encoder_out, template, targets, tokens, batch_size
+    ).numpy()
+
+    return logp.sum(axis=1), logp
+
+
+def saturation_mutagenesis(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    prepared: PreparedComplex,
+    basedir: Optional[str] = None,
+) -> pd.DataFrame:
+    # Native residues at designed positions
+    native = [prepared.native_seq[index] for index in prepared.indexes]
+
+    # Score all 20 residues at every designed position, other positions native
+    device = _model_device(model)
+    encoder_out = encode_structure(model, alphabet, prepared.coords, device=device)
+    template = tokenize(alphabet, _native_pattern(prepared), device)
+    targets = [index + 1 for index in prepared.indexes]
+    substitutions = torch.tensor(
+        [alphabet.get_idx(aa) for aa in AMINO_ACIDS], device=device
+    )
+
+    # Change in log-likelihood of the designed positions relative to native
+    delta = np.zeros((len(targets), len(AMINO_ACIDS)), dtype=np.float32)
+    if len(targets) > 0:
+        mutant_logp, native_logp = scan_tokens(
+            model, alphabet, encoder_out, template, targets, substitutions
+        )
+        delta = (mutant_logp - native_logp.unsqueeze(-1)).numpy()
+
+    # Position x amino acid matrix
+    matrix = pd.DataFrame(delta, index=prepared.design, columns=AMINO_ACIDS)
+    matrix.insert(0, "native", native)
+    matrix.index.name = "position"
+
+    # Save next to the designs of the structure
+    if basedir is not None:
+        matrix.to_csv(os.path.join(basedir, f"{prepared.name}_mutagenesis.csv"))
+
+    return matrix
+
+
+def check_precision(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    prepared: List[PreparedComplex],
+    precision: str,
+    num_samples: int = 10,
+    temperature: float = 0.2,
+    seed: Optional[int] = 37,
+) -> pd.DataFrame:
+    # Compare a precision mode against the fp32 model on every structure:
+    # per-position log-probabilities of the 20 amino acids at designed
+    # positions (teacher-forced on the native sequence) and sequence recovery
+    # of samples drawn with the same seeds
+    models = {"fp32": model, precision: set_precision(model, precision)}
+    device = _model_device(model)
+    amino_acids = [alphabet.get_idx(aa) for aa in AMINO_ACIDS]
+
+    rows = []
+    for structure in prepared:
+        if len(structure.indexes) == 0:
+            continue
+        targets = [index + 1 for index in structure.indexes]
+        seeds = None
+        if seed is not None:
+            seeds = get_replicate_seeds(seed, structure.name, num_samples)
+
+        logp, recovery, designs = {}, {}, {}
+        for mode, mode_model in models.items():
+            encoder_out = encode_structure(
+                mode_model, alphabet, structure.coords, device=device
+            )
+
+            # Log-probabilities [P, 20] given the native sequence
+            tokens = tokenize(alphabet, _native_pattern(structure), device)
+            logits = forward_logits(
+                mode_model, alphabet, encoder_out, tokens, targets
+            )[0]
+            logp[mode] = F.log_softmax(logits.float(), dim=-1)[:, amino_acids].cpu()
+
+            # Recovery of seeded samples
+            sampled = sample_sequences(
+                mode_model,
+                alphabet,
+                encoder_out,
+                structure.padding_pattern,
+                num_samples=num_samples,
+                temperature=temperature,
+                device=device,
+                seeds=seeds,
+            )
+            codes = _to_codes(sampled, alphabet, structure)
+            recovery[mode] = sum(_recoveries(codes, structure)) / num_samples
+            designs[mode] = codes[:, structure.indexes]
+
+        difference = (logp[precision] - logp["fp32"]).abs()
+        rows.append(
+            {
+                "pdb": structure.name,
+                "precision": precision,
+                "max_logp_diff": difference.max().item(),
+                "mean_logp_diff": difference.mean().item(),
+                "recovery_fp32": recovery["fp32"],
+                "recovery": recovery[precision],
+                "delta_recovery": recovery[precision] - recovery["fp32"],
+                # Same seeds, so designs only differ where the mode changed
+                # the sampled residue
+                "identical_residues": float(
+                    (designs[precision] == designs["fp32"]).mean()
+                ),
+            }
+        )
+
+    return pd.DataFrame(rows)
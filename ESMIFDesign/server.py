@@ -0,0 +1,366 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import esm
+from esm.data import Alphabet
+from esm.inverse_folding.gvp_transformer import GVPTransformerModel
+
+from .compiled import compile_decoder
+from .esmif import prepare_sample_output, sample_seq_multichain, write_fasta
+from .precision import PRECISIONS, set_precision
+from .structure import PreparedComplex, prepare_complex
+from .utils import get_chains
+
+logger = logging.getLogger(__name__)
+
+# Long-running design service holding ESM-IF1 in memory. Jobs received within
+# a short window are grouped and jobs on the same structure, design and
+# temperature share one batched sampling call. Paths of HTTP requests are
+# resolved under the root directory of the server, so clients cannot read or
+# write files outside of it.
+
+# Maximum number of prepared structures kept in memory
+PREPARED_CACHE_SIZE = 64
+
+
+@dataclass
+class DesignJob:
+    pdbfile: str
+    design: List[str]
+    num_samples: int = 1
+    temperature: float = 1.0
+    padding_length: int = 10
+    outpath: Optional[str] = None
+    basedir: Optional[str] = None
+    future: Future = field(default_factory=Future)
+
+    @property
+    def key(self) -> Tuple:
+        # Jobs with the same key are sampled together. The order of design
+        # residues only matters through the order of their chains.
+        return (
+            self.pdbfile,
+            tuple(get_chains(self.design)),
+            tuple(sorted(self.design)),
+            self.temperature,
+            self.padding_length,
+        )
+
+
+# Fields a client may set and their accepted types (future is set by the server)
+_JOB_FIELDS = {
+    "pdbfile": (str,),
+    "design": (list,),
+    "num_samples": (int,),
+    "temperature": (int, float),
+    "padding_length": (int,),
+    "outpath": (str, type(None)),
+    "basedir": (str, type(None)),
+}
+
+
+def _resolve(root: str, path: str) -> str:
+    # Path below root (absolute paths, .. and symlinks leaving root are rejected)
+    if os.path.isabs(path) or ".." in Path(path).parts:
+        raise ValueError(f"Path must be relative to the server root: {path}")
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"Path must be relative to the server root: {path}")
+    return resolved
+
+
+def _parse_job(payload: Any, root: str) -> DesignJob:
+    # Build a job from a request body, rejecting unknown keys, wrong types and
+    # paths outside of root
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a JSON object")
+    unknown = sorted(set(payload) - set(_JOB_FIELDS))
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    for key, value in payload.items():
+        # bool is a subclass of int, but never a valid number here
+        if isinstance(value, bool) or not isinstance(value, _JOB_FIELDS[key]):
+            raise ValueError(f"Invalid type for {key}: {type(value).__name__}")
+    if not all(isinstance(residue, str) for residue in payload.get("design", [])):
+        raise ValueError("design must be a list of strings")
+    job = DesignJob(**payload)
+    if job.num_samples < 1:
+        raise ValueError("num_samples must be positive")
+    if job.temperature <= 0:
+        raise ValueError("temperature must be positive")
+    if job.padding_length < 0:
+        raise ValueError("padding_length must not be negative")
+    if not job.pdbfile.endswith(".pdb"):
+        raise ValueError(f"Not a PDB file: {job.pdbfile}")
+    job.pdbfile = _resolve(root, job.pdbfile)
+    if job.outpath is not None:
+        job.outpath = _resolve(root, job.outpath)
+    if job.basedir is not None:
+        job.basedir = _resolve(root, job.basedir)
+    return job
+
+
+class DesignServer:
+    def __init__(
+        self,
+        model: GVPTransformerModel,
+        alphabet: Alphabet,
+        batch_size: int = 32,
+        window: float = 0.05,
+        max_jobs: int = 64,
+        cache_dir: Optional[str] = None,
+        root: str = ".",
+    ):
+        self.model = model
+        self.alphabet = alphabet
+        self.batch_size = batch_size
+        self.window = window
+        self.max_jobs = max_jobs
+        self.cache_dir = cache_dir
+        self.root = os.path.realpath(root)
+        self._jobs: "queue.Queue[DesignJob]" = queue.Queue()
+        self._prepared: "OrderedDict[Tuple, PreparedComplex]" = OrderedDict()
+
+        # Model is only used from a single worker thread
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, job: DesignJob) -> Future:
+        self._jobs.put(job)
+        return job.future
+
+    def _prepare(self, job: DesignJob) -> PreparedComplex:
+        # Reuse prepared structures across jobs
+        key = job.key[:3] + (job.padding_length,)
+        if key in self._prepared:
+            self._prepared.move_to_end(key)
+            return self._prepared[key]
+        prepared = prepare_complex(
+            job.pdbfile,
+            get_chains(job.design),
+            job.design,
+            job.padding_length,
+            self.cache_dir,
+        )
+        self._prepared[key] = prepared
+        while len(self._prepared) > PREPARED_CACHE_SIZE:
+            self._prepared.popitem(last=False)
+        return prepared
+
+    def _run(self) -> None:
+        while True:
+            # Collect jobs arriving within the batching window
+            batch = [self._jobs.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_jobs:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._jobs.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Group compatible jobs into shared sampling calls. A failing group
+            # fails its jobs, but never the worker thread.
+            groups: Dict[Tuple, List[DesignJob]] = OrderedDict()
+            for job in batch:
+                try:
+                    groups.setdefault(job.key, []).append(job)
+                except Exception as error:
+                    job.future.set_exception(error)
+            for jobs in groups.values():
+                try:
+                    self._process(jobs)
+                except Exception as error:
+                    logger.exception("Design jobs failed")
+                    for job in jobs:
+                        if not job.future.done():
+                            job.future.set_exception(error)
+
+    def _process(self, jobs: List[DesignJob]) -> None:
+        try:
+            prepared = self._prepare(jobs[0])
+            samples, recoveries = sample_seq_multichain(
+                self.model,
+                self.alphabet,
+                prepared,
+                prepared.chains,
+                prepared.design,
+                None,
+                sum(job.num_samples for job in jobs),
+                jobs[0].temperature,
+                prepared.padding_length,
+                False,
+                self.batch_size,
+            )
+        except Exception as error:
+            for job in jobs:
+                job.future.set_exception(error)
+            return
+
+        # Split samples back per job
+        start = 0
+        for job in jobs:
+            end = start + job.num_samples
+            try:
+                if job.outpath is not None:
+                    write_fasta(job.outpath, prepared.native_seq, samples[start:end])
+                designs = prepare_sample_output(
+                    samples[start:end],
+                    prepared,
+                    prepared.chains,
+                    prepared.design,
+                    prepared.padding_length,
+                    job.basedir,
+                )
+
+                # Designed residues in the order requested by the job
+                order = [prepared.design.index(residue) for residue in job.design]
+                designs = ["".join(design[i] for i in order) for design in designs]
+                job.future.set_result(
+                    {
+                        "samples": samples[start:end],
+                        "recoveries": [float(r) for r in recoveries[start:end]],
+                        "designs": designs,
+                    }
+                )
+            except Exception as error:
+                job.future.set_exception(error)
+            start = end
+
+
+def _handler(server: DesignServer) -> type:
+    class DesignRequestHandler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: Dict[str, Any]) -> None:
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path == "/health":
+                self._reply(200, {"status": "ok"})
+            else:
+                self._reply(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self) -> None:
+            if self.path != "/design":
+                self._reply(404, {"error": f"Unknown path: {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                job = _parse_job(json.loads(self.rfile.read(length)), server.root)
+            except (TypeError, ValueError) as error:
+                self._reply(400, {"error": str(error)})
+                return
+            try:
+                self._reply(200, server.submit(job).result())
+            except Exception as error:
+                self._reply(500, {"error": str(error)})
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    return DesignRequestHandler
+
+
+def serve(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    batch_size: int = 32,
+    window: float = 0.05,
+    cache_dir: Optional[str] = None,
+    root: str = ".",
+) -> None:
+    server = DesignServer(
+        model, alphabet, batch_size, window, cache_dir=cache_dir, root=root
+    )
+    httpd = ThreadingHTTPServer((host, port), _handler(server))
+    logger.info("> Serving ESM-IF1 designs on http://%s:%d", host, port)
+    logger.info("> Request paths are resolved under %s", server.root)
+    httpd.serve_forever()
+
+
+def request_design(
+    pdbfile: str,
+    design: List[str],
+    num_samples: int = 1,
+    temperature: float = 1.0,
+    padding_length: int = 10,
+    outpath: Optional[str] = None,
+    basedir: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+) -> Dict[str, Any]:
+    # Submit a design job to a running server and wait for the result
+    job = {
+        "pdbfile": pdbfile,
+        "design": design,
+        "num_samples": num_samples,
+        "temperature": temperature,
+        "padding_length": padding_length,
+        "outpath": outpath,
+        "basedir": basedir,
+    }
+    request = urllib.request.Request(
+        f"http://{host}:{port}/design",
+        data=json.dumps(job).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ESM-IF1 design server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--window", type=float, default=0.05)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument(
+        "--root",
+        default=".",
+        help="Directory that PDB files and output paths of requests are read from "
+        "and written to",
+    )
+    parser.add_argument("--precision", default="fp32", choices=PRECISIONS)
+    parser.add_argument(
+        "--compile", action="store_true", help="Compile the decoder step"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    # Load model once and keep it in memory
+    model, alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
+    model = set_precision(model.eval(), args.precision)
+    if args.compile:
+        model = compile_decoder(model)
+
+    serve(
+        model,
+        alphabet,
+        args.host,
+        args.port,
+        args.batch_size,
+        args.window,
+        args.cache_dir,
+        args.root,
+    )
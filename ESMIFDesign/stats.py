@@ -0,0 +1,89 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Statistics of designs stored as a [N, P] matrix of residue codes (one byte
+# per designed position), computed without Python loops over samples.
+
+AMINO_ACIDS = [
+    "A",
+    "C",
+    "D",
+    "E",
+    "F",
+    "G",
+    "H",
+    "I",
+    "K",
+    "L",
+    "M",
+    "N",
+    "P",
+    "Q",
+    "R",
+    "S",
+    "T",
+    "V",
+    "W",
+    "Y",
+]
+
+_AMINO_ACID_CODES = np.frombuffer("".join(AMINO_ACIDS).encode("ascii"), np.uint8)
+
+
+def design_matrix(designs: List[str]) -> np.ndarray:
+    # Equal-length designs (one-letter residues) as a [N, P] uint8 matrix
+    if len(designs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    encoded = np.frombuffer("".join(designs).encode("ascii"), dtype=np.uint8)
+    return encoded.reshape(len(designs), -1)
+
+
+def residue_counts(matrix: np.ndarray) -> np.ndarray:
+    # Count of every residue code at every position [P, 256], in one bincount
+    P = matrix.shape[1]
+    offsets = np.arange(P) * 256
+    counts = np.bincount((matrix + offsets).ravel(), minlength=P * 256)
+    return counts.reshape(P, 256)
+
+
+def get_recovery(matrix: np.ndarray, native: str) -> np.ndarray:
+    # Fraction of designed positions with the native residue, per design
+    native = np.frombuffer(native.encode("ascii"), dtype=np.uint8)
+    return (matrix == native).mean(axis=1)
+
+
+def get_uniqueness(matrix: np.ndarray) -> float:
+    # Number of unique designs / total number of designs
+    if len(matrix) == 0:
+        return 0.0
+    return len(np.unique(matrix, axis=0)) / len(matrix)
+
+
+def get_frequency(
+    matrix: np.ndarray, num_samples: Optional[int] = None
+) -> Dict[str, List[float]]:
+    # Frequency of the 20 amino acids per position (same layout as
+    # get_frequency_of_residues)
+    num_samples = len(matrix) if num_samples is None else num_samples
+    frequency = residue_counts(matrix)[:, _AMINO_ACID_CODES].T / num_samples
+    return {aa: frequency[i].tolist() for i, aa in enumerate(AMINO_ACIDS)}
+
+
+def get_entropy(matrix: np.ndarray) -> np.ndarray:
+    # Shannon entropy (bits) of the residues at every position
+    probs = residue_counts(matrix) / max(len(matrix), 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(probs > 0, -probs * np.log2(probs), 0.0)
+    return terms.sum(axis=1)
+
+
+def get_diversity(matrix: np.ndarray) -> float:
+    # Mean Hamming distance over all pairs of designs. Pairs that differ at a
+    # position are counted from the residue counts, without the N x N matrix.
+    N = len(matrix)
+    if N < 2:
+        return 0.0
+    counts = residue_counts(matrix)
+    different = N * N - (counts.astype(np.int64) ** 2).sum(axis=1)
+    return float(different.sum() / (N * (N - 1)))
@@ -0,0 +1,258 @@
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import esm
+import numpy as np
+
+from .profiling import stage
+
+# Bump to invalidate preprocessed structures written by older versions
+STRUCTURE_CACHE_VERSION = "1"
+
+
+@dataclass
+class PreparedComplex:
+    # Structure file and design specification
+    pdbfile: str
+    chains: List[str]
+    design: List[str]
+    padding_length: int
+    # Chain layout of the concatenated complex (target chains first)
+    chain_order: List[str]
+    chain_sizes: List[int]
+    # Concatenated backbone coordinates (N, CA, C) with NaN padding
+    coords: np.ndarray
+    # Native sequence with "-" between chains
+    native_seq: List[str]
+    # Indexes of design residues in the concatenated complex, in the same order
+    # as design
+    indexes: List[int]
+    # Native residues, <mask> for designed residues and <pad> between chains
+    padding_pattern: List[str]
+    # Length of target chains (and their padding) in the concatenated complex
+    target_len: int
+
+    @property
+    def name(self) -> str:
+        return os.path.basename(self.pdbfile).replace(".pdb", "")
+
+
+def _concatenate_multichain_coords(
+    coords: Dict[str, np.ndarray], target_chain_ids: List[str], padding_length: int = 10
+) -> np.ndarray:
+    # Padding coordinates between concatenated chains
+    pad_coords = np.full((padding_length, 3, 3), np.nan, dtype=np.float32)
+
+    # For best performance, put the target chains first in concatenation.
+    coords_list = []
+    for chain_id in target_chain_ids:
+        if len(coords_list) > 0:
+            coords_list.append(pad_coords)
+        coords_list.append(coords[chain_id])
+
+    # Concatenate remaining chains
+    for chain_id in coords:
+        if chain_id in target_chain_ids:
+            continue
+        coords_list.append(pad_coords)
+        coords_list.append(coords[chain_id])
+
+    # Concatenate all chains
+    coords_concatenated = np.concatenate(coords_list, axis=0)
+
+    return coords_concatenated
+
+
+def _design_indexes(
+    ca_res_id: np.ndarray,
+    ca_chain_id: np.ndarray,
+    chain_order: List[str],
+    chain_sizes: List[int],
+    design: List[str],
+    padding_length: int = 10,
+) -> Tuple[List[int], List[str]]:
+    # Position of every CA atom in the concatenated complex
+    position = np.full(len(ca_res_id), -1)
+    start = 0
+    for chain_id, size in zip(chain_order, chain_sizes):
+        in_chain = ca_chain_id == chain_id
+        position[in_chain] = start + np.arange(in_chain.sum())
+        start += size + padding_length
+
+    # Match (res_id, chain_id) of design residues against all CA atoms at once
+    design_res_id = np.array([int(residue[:-1]) for residue in design])
+    design_chain_id = np.array([residue[-1] for residue in design])
+    match = (ca_res_id[None, :] == design_res_id[:, None]) & (
+        ca_chain_id[None, :] == design_chain_id[:, None]
+    )
+
+    # Design residues must exist in the structure
+    missing = ~match.any(axis=1)
+    if missing.any():
+        raise ValueError(
+            "Design residues not found in structure: "
+            + ", ".join(np.array(design)[missing])
+        )
+
+    # Indexes and labels of design residues in the concatenated complex
+    selected = match.any(axis=0)
+    order = np.argsort(position[selected], kind="stable")
+    indexes = position[selected][order]
+    labels = [
+        f"{res_id}{chain_id}"
+        for res_id, chain_id in zip(
+            ca_res_id[selected][order], ca_chain_id[selected][order]
+        )
+    ]
+
+    return indexes.tolist(), labels
+
+
+def _parse_structure(
+    pdbfile: str,
+) -> Tuple[Dict[str, np.ndarray], Dict[str, str], np.ndarray, np.ndarray]:
+    # Load structure
+    structure = esm.inverse_folding.util.load_structure(pdbfile)
+    coords, native_seqs = (
+        esm.inverse_folding.multichain_util.extract_coords_from_complex(structure)
+    )
+
+    # Residue numbering and chain of CA atoms
+    ca = structure[structure.atom_name == "CA"]
+
+    return coords, native_seqs, ca.res_id, ca.chain_id
+
+
+def _file_digest(pdbfile: str) -> "hashlib._Hash":
+    with open(pdbfile, "rb") as f:
+        return hashlib.sha256(f.read())
+
+
+def pdb_digest(pdbfile: str) -> str:
+    # SHA-256 of the content of a PDB file
+    return _file_digest(pdbfile).hexdigest()
+
+
+def _load_structure(
+    pdbfile: str, cache_dir: Optional[str] = None
+) -> Tuple[Dict[str, np.ndarray], Dict[str, str], np.ndarray, np.ndarray]:
+    if cache_dir is None:
+        return _parse_structure(pdbfile)
+
+    # Cache entries are keyed by the content of the PDB file
+    digest = _file_digest(pdbfile)
+    digest.update(STRUCTURE_CACHE_VERSION.encode())
+    cachefile = os.path.join(cache_dir, f"{digest.hexdigest()}.npz")
+
+    # Read preprocessed structure
+    if os.path.exists(cachefile):
+        with np.load(cachefile) as data:
+            coords, native_seqs = {}, {}
+            for chain_id in data["chains"]:
+                coords[str(chain_id)] = data[f"coords_{chain_id}"]
+                native_seqs[str(chain_id)] = str(data[f"seq_{chain_id}"])
+            return coords, native_seqs, data["ca_res_id"], data["ca_chain_id"]
+
+    # Parse and store preprocessed structure
+    coords, native_seqs, ca_res_id, ca_chain_id = _parse_structure(pdbfile)
+    arrays = {"chains": np.array(list(coords)), "ca_res_id": ca_res_id}
+    arrays["ca_chain_id"] = ca_chain_id
+    for chain_id in coords:
+        arrays[f"coords_{chain_id}"] = coords[chain_id]
+        arrays[f"seq_{chain_id}"] = np.array(native_seqs[chain_id])
+    os.makedirs(cache_dir, exist_ok=True)
+    tmpfile = f"{cachefile}.{os.getpid()}.tmp"
+    with open(tmpfile, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmpfile, cachefile)
+
+    return coords, native_seqs, ca_res_id, ca_chain_id
+
+
+def _assemble_complex(
+    pdbfile: str,
+    chains: List[str],
+    design: List[str],
+    padding_length: int,
+    coords: Dict[str, np.ndarray],
+    native_seqs: Dict[str, str],
+    ca_res_id: np.ndarray,
+    ca_chain_id: np.ndarray,
+) -> PreparedComplex:
+    # Prepare input for sampling
+    all_coords = _concatenate_multichain_coords(
+        coords, chains, padding_length=padding_length
+    )
+
+    # Get all_coords chain ordering (same order as the concatenated coordinates)
+    all_coords_chains = list(chains) + [
+        chain_id for chain_id in coords if chain_id not in chains
+    ]
+
+    # Get chain sizes
+    chain_sizes = [len(native_seqs[chain_id]) for chain_id in all_coords_chains]
+
+    # Get length of target chain
+    target_chain_len = 0
+    for chain_id, size in zip(all_coords_chains, chain_sizes):
+        if chain_id in chains:
+            target_chain_len += size + padding_length
+
+    # Get native sequence
+    native_seq = []
+    for i, chain_id in enumerate(all_coords_chains):
+        for j in range(chain_sizes[i]):
+            native_seq.append(native_seqs[chain_id][j])
+        if i < len(all_coords_chains) - 1:
+            for j in range(padding_length):
+                native_seq.append("-")
+
+    # Prepare design indexes (and design residues in the same order)
+    indexes, design = _design_indexes(
+        ca_res_id, ca_chain_id, all_coords_chains, chain_sizes, design, padding_length
+    )
+
+    # Supply padding tokens for other chains to avoid unused sampling for speed
+    # <res_name> for fixed residues
+    # <mask> for designed residues
+    # <pad> to ignore other chains
+    padding_pattern = [token if token != "-" else "<pad>" for token in native_seq]
+    for index in indexes:
+        padding_pattern[index] = "<mask>"
+
+    return PreparedComplex(
+        pdbfile=pdbfile,
+        chains=list(chains),
+        design=list(design),
+        padding_length=padding_length,
+        chain_order=all_coords_chains,
+        chain_sizes=chain_sizes,
+        coords=all_coords,
+        native_seq=native_seq,
+        indexes=indexes,
+        padding_pattern=padding_pattern,
+        target_len=target_chain_len,
+    )
+
+
+def prepare_complex(
+    pdbfile: str,
+    chains: List[str],
+    design: List[str],
+    padding_length: int = 10,
+    cache_dir: Optional[str] = None,
+) -> PreparedComplex:
+    # Load structure (from the preprocessed structure cache if available)
+    with stage("load", pdbfile=pdbfile, structure_cache=cache_dir is not None):
+        structure = _load_structure(pdbfile, cache_dir)
+
+    # Concatenate chains and locate design residues
+    with stage("prepare", pdbfile=pdbfile) as event:
+        prepared = _assemble_complex(
+            pdbfile, chains, design, padding_length, *structure
+        )
+        event.update(length=len(prepared.coords), designed=len(prepared.indexes))
+
+    return prepared
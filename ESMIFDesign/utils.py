@@ -1,6 +1,9 @@
+import hashlib
 import json
 from typing import Dict, List
 
+from .stats import design_matrix, get_frequency
+
 
 def get_chains(design: List[str]) -> List[str]:
     # Get all chains
@@ -13,37 +16,23 @@ def get_chains(design: List[str]) -> List[str]:
 
 
 def get_frequency_of_residues(designs: List[str], num_samples: int) -> Dict[str, int]:
-    AA = [
-        "A",
-        "C",
-        "D",
-        "E",
-        "F",
-        "G",
-        "H",
-        "I",
-        "K",
-        "L",
-        "M",
-        "N",
-        "P",
-        "Q",
-        "R",
-        "S",
-        "T",
-        "V",
-        "W",
-        "Y",
-    ]
-
-    frequency = {}
-    for aa in AA:
-        frequency[aa] = [item.count(aa) / num_samples for item in zip(*designs)]
-
-    return frequency
+    # Vectorized counts over the design matrix (see stats)
+    return get_frequency(design_matrix(designs), num_samples)
 
 
 def read_config(filepath: str) -> Dict[str, List[str]]:
     with open(filepath, "r") as f:
         config = json.load(f)
     return config
+
+
+def get_replicate_seeds(
+    seed: int, name: str, num_samples: int, start: int = 0
+) -> List[int]:
+    # Stable seed for each (seed, structure, replicate), independent of the
+    # process and of the order in which structures are processed
+    seeds = []
+    for replicate in range(start, start + num_samples):
+        digest = hashlib.sha256(f"{seed}:{name}:{replicate}".encode()).digest()
+        seeds.append(int.from_bytes(digest[:8], "little") & 0x7FFFFFFFFFFFFFFF)
+    return seeds
@@ -0,0 +1,170 @@
+import os
+from typing import List
+
+import numpy as np
+
+from .profiling import stage
+from .structure import PreparedComplex
+
+# Streaming writer of sampled designs to compressed Parquet files. Results are
+# buffered as Arrow tables and written one row group at a time, so memory does
+# not grow with the number of samples. Requires pyarrow.
+
+
+class ResultWriter:
+    def __init__(
+        self,
+        path: str,
+        full_sequence: bool = False,
+        row_group_size: int = 65536,
+        compression: str = "zstd",
+    ):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as error:
+            raise ImportError(
+                "ResultWriter requires pyarrow (pip install pyarrow)"
+            ) from error
+        self._pa, self._pq = pa, pq
+
+        self.path = path
+        self.full_sequence = full_sequence
+        self.row_group_size = row_group_size
+        self.compression = compression
+
+        # One row per (sample, designed position)
+        self._schema = pa.schema(
+            [
+                ("pdb", pa.string()),
+                ("replicate", pa.int32()),
+                ("position", pa.string()),
+                ("native", pa.string()),
+                ("designed", pa.string()),
+                ("chain", pa.string()),
+                ("temperature", pa.float32()),
+                ("recovery", pa.float32()),
+            ]
+        )
+        # One row per sample with the sequence of the target chains
+        self._sequence_schema = pa.schema(
+            [
+                ("pdb", pa.string()),
+                ("replicate", pa.int32()),
+                ("temperature", pa.float32()),
+                ("recovery", pa.float32()),
+                ("sequence", pa.string()),
+            ]
+        )
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._writers, self._buffers = {}, {}
+
+    @property
+    def sequence_path(self) -> str:
+        return os.path.splitext(self.path)[0] + "_sequences.parquet"
+
+    def write(
+        self,
+        prepared: PreparedComplex,
+        designs: List[str],
+        recoveries: List[float],
+        temperature: float,
+        start: int = 0,
+    ) -> None:
+        # designs are the designed residues of each sample, in the order of
+        # prepared.design (as returned by prepare_sample_output). Replicates are
+        # numbered from start + 1.
+        n = len(designs)
+        if n == 0:
+            return
+        with stage("write", name=prepared.name, path=self.path, num_samples=n):
+            self._write(prepared, designs, recoveries, temperature, start)
+
+    def _write(
+        self,
+        prepared: PreparedComplex,
+        designs: List[str],
+        recoveries: List[float],
+        temperature: float,
+        start: int,
+    ) -> None:
+        n, P = len(designs), len(prepared.indexes)
+        pa = self._pa
+
+        # Columns of designed positions, built without a loop over samples
+        native = [prepared.native_seq[index] for index in prepared.indexes]
+        replicates = np.arange(start + 1, start + n + 1, dtype=np.int32)
+        recoveries = np.asarray(recoveries, dtype=np.float32)
+        table = pa.table(
+            {
+                "pdb": pa.array([prepared.name] * (n * P), pa.string()),
+                "replicate": np.repeat(replicates, P),
+                "position": pa.array(
+                    [residue[:-1] for residue in prepared.design] * n, pa.string()
+                ),
+                "native": pa.array(native * n, pa.string()),
+                "designed": pa.array(list("".join(designs)), pa.string()),
+                "chain": pa.array(
+                    [residue[-1] for residue in prepared.design] * n, pa.string()
+                ),
+                "temperature": np.full(n * P, temperature, dtype=np.float32),
+                "recovery": np.repeat(recoveries, P),
+            },
+            schema=self._schema,
+        )
+        self._append(self.path, self._schema, table)
+
+        if self.full_sequence:
+            # Fixed residues are teacher-forced, so each sample is the native
+            # sequence of the target chains with its designed residues
+            sequences = []
+            for design in designs:
+                sample = list(prepared.native_seq[: prepared.target_len])
+                for index, residue in zip(prepared.indexes, design):
+                    sample[index] = residue
+                sequences.append("".join(sample))
+            table = pa.table(
+                {
+                    "pdb": pa.array([prepared.name] * n, pa.string()),
+                    "replicate": replicates,
+                    "temperature": np.full(n, temperature, dtype=np.float32),
+                    "recovery": recoveries,
+                    "sequence": pa.array(sequences, pa.string()),
+                },
+                schema=self._sequence_schema,
+            )
+            self._append(self.sequence_path, self._sequence_schema, table)
+
+    def _append(self, path: str, schema, table) -> None:
+        # Buffer tables and write full row groups
+        buffer = self._buffers.setdefault(path, [])
+        buffer.append(table)
+        if sum(len(t) for t in buffer) >= self.row_group_size:
+            self._flush(path, schema)
+
+    def _flush(self, path: str, schema) -> None:
+        buffer = self._buffers.get(path)
+        if not buffer:
+            return
+        if path not in self._writers:
+            self._writers[path] = self._pq.ParquetWriter(
+                path, schema, compression=self.compression
+            )
+        self._writers[path].write_table(
+            self._pa.concat_tables(buffer), row_group_size=self.row_group_size
+        )
+        buffer.clear()
+
+    def close(self) -> None:
+        self._flush(self.path, self._schema)
+        self._flush(self.sequence_path, self._sequence_schema)
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from ESMIFDesign import esm, get_chains, read_config, sample_seq_multichain
+
+# Just suppress all warnings with this:
+warnings.filterwarnings("ignore")
+
+# CONSTANTS
+NUM_SAMPLES = 10
+TEMPERATURE = 0.2
+PADDING = 10
+BATCH_SIZE = 32
+SEED = 37
+CROP_RADII = [None, 20.0, 15.0, 10.0]
+CROP_MARGIN = 3
+
+if __name__ == "__main__":
+    # Load model
+    model, alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
+
+    # use eval mode for deterministic output e.g. without random dropout
+    model = model.eval()
+
+    # Read configuration file
+    config = read_config("config.json")
+
+    # Benchmark every structure in data/ with and without cropping
+    rows = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for pdb in config:
+            pdbfile = os.path.join("data", f"{pdb}.pdb")
+            design = config[pdb]
+            chains = get_chains(design)
+
+            for radius in CROP_RADII:
+                print(f"[==> {pdb} (crop radius: {radius})")
+
+                # Same seed for every mode
+                torch.manual_seed(SEED)
+                np.random.seed(SEED)
+
+                start = time.perf_counter()
+                samples, recoveries = sample_seq_multichain(
+                    model,
+                    alphabet,
+                    pdbfile,
+                    chains,
+                    design,
+                    os.path.join(tmpdir, f"{pdb}.fasta"),
+                    NUM_SAMPLES,
+                    TEMPERATURE,
+                    PADDING,
+                    False,
+                    BATCH_SIZE,
+                    crop_radius=radius,
+                    crop_margin=CROP_MARGIN,
+                )
+                elapsed = time.perf_counter() - start
+
+                rows.append(
+                    {
+                        "pdb": pdb,
+                        "radius": "full" if radius is None else radius,
+                        "time": elapsed,
+                        "recovery": np.mean(recoveries),
+                    }
+                )
+
+    # Speedup and recovery change relative to the full complex
+    results = pd.DataFrame(rows)
+    full = results[results["radius"] == "full"].set_index("pdb")
+    results["speedup"] = full.loc[results["pdb"], "time"].values / results["time"]
+    results["delta_recovery"] = (
+        results["recovery"] - full.loc[results["pdb"], "recovery"].values
+    )
+
+    os.makedirs(os.path.join("benchmarks", "results"), exist_ok=True)
+    results.to_csv(os.path.join("benchmarks", "results", "cropping.csv"), index=False)
+
+    # Show summary to user
+    summary = results.groupby("radius", sort=False)[
+        ["time", "speedup", "recovery", "delta_recovery"]
+    ].mean()
+    print(summary)
@@ -0,0 +1,274 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from ESMIFDesign import (
+    compile_decoder,
+    esm,
+    get_chains,
+    get_replicate_seeds,
+    prepare_sample_output,
+)
+from ESMIFDesign.decoding import clear_encoder_cache, encode_structure, sample_sequences
+from ESMIFDesign.esmif import _recoveries, _to_codes, _to_text, write_fasta
+from ESMIFDesign.structure import _assemble_complex, _load_structure
+
+# Just suppress all warnings with this:
+warnings.filterwarnings("ignore")
+
+# CONSTANTS
+TEMPERATURE = 0.2
+PADDING = 10
+BATCH_SIZE = 32
+SEED = 37
+THREADS = 4
+REPEATS = 3
+
+# Small (TCR only) and large (TCR-pMHC) complexes of the same structure
+STRUCTURES = {
+    "small": os.path.join("tests", "data", "6ZKW", "6ZKW_DE.pdb"),
+    "large": os.path.join("data", "6zkw.pdb"),
+}
+DESIGN_SETS = {
+    "CDR3": os.path.join("tests", "CDR3.json"),
+    "CDRs_interface": os.path.join("tests", "CDRs_interface.json"),
+}
+NUM_SAMPLES = [1, 500]
+
+# Model shared with forked scenario processes (copy-on-write)
+_model = None
+_alphabet = None
+
+
+def _peak_rss_mb() -> float:
+    # Peak resident set size of this process (ru_maxrss is in KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _timed(function: Callable, repeats: int) -> Tuple[object, List[float]]:
+    # Wall times of repeated calls and the output of the last one
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+    return output, times
+
+
+def _scenarios() -> List[Dict]:
+    scenarios = []
+    for size, pdbfile in STRUCTURES.items():
+        for design_set, config in DESIGN_SETS.items():
+            with open(config, "r") as f:
+                design = json.load(f)["6zkw"]
+            for num_samples in NUM_SAMPLES:
+                scenarios.append(
+                    {
+                        "name": f"{size}-{design_set}-{num_samples}",
+                        "structure": size,
+                        "pdbfile": pdbfile,
+                        "design_set": design_set,
+                        "design": design,
+                        "num_samples": num_samples,
+                    }
+                )
+    return scenarios
+
+
+def run_scenario(scenario: Dict) -> Dict:
+    torch.set_num_threads(THREADS)
+    pdbfile, design = scenario["pdbfile"], scenario["design"]
+    num_samples = scenario["num_samples"]
+    chains = get_chains(design)
+
+    # Decoding is the expensive stage, so it is timed once for many samples
+    repeats = REPEATS if num_samples == 1 else 1
+    stages = {}
+
+    def record(stage: str, times: List[float], residues: int, samples: int):
+        elapsed = float(np.median(times))
+        stages[stage] = {
+            "time": elapsed,
+            "times": times,
+            "samples_per_sec": samples / elapsed if samples > 0 else None,
+            "residues_per_sec": residues / elapsed,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+
+    # PDB load (no structure cache)
+    structure, times = _timed(lambda: _load_structure(pdbfile), REPEATS)
+    residues = sum(len(seq) for seq in structure[1].values())
+    record("load", times, residues, 0)
+
+    # Coordinate concatenation and design indexes
+    prepared, times = _timed(
+        lambda: _assemble_complex(pdbfile, chains, design, PADDING, *structure),
+        REPEATS,
+    )
+    length = len(prepared.padding_pattern)
+    record("concatenate", times, length, 0)
+
+    # Encoding (encoder cache cleared before every call)
+    def encode():
+        clear_encoder_cache()
+        return encode_structure(_model, _alphabet, prepared.coords, device="cpu")
+
+    encoder_out, times = _timed(encode, REPEATS)
+    record("encode", times, length, 0)
+
+    # Decoding of all samples with per-replicate seeds
+    seeds = get_replicate_seeds(SEED, prepared.name, num_samples)
+    designed = num_samples * len(prepared.indexes)
+    tokens, times = _timed(
+        lambda: sample_sequences(
+            _model,
+            _alphabet,
+            encoder_out,
+            prepared.padding_pattern,
+            num_samples=num_samples,
+            temperature=TEMPERATURE,
+            batch_size=BATCH_SIZE,
+            device="cpu",
+            seeds=seeds,
+        ),
+        repeats,
+    )
+    record("decode", times, designed, num_samples)
+
+    # Output writing: samples, recoveries, FASTA and per-residue CSV
+    with tempfile.TemporaryDirectory() as tmpdir:
+
+        def write():
+            codes = _to_codes(tokens, _alphabet, prepared)
+            codes = codes[:, : prepared.target_len]
+            samples, recoveries = _to_text(codes), _recoveries(codes, prepared)
+            outpath = os.path.join(tmpdir, "samples.fasta")
+            write_fasta(outpath, prepared.native_seq, samples)
+            prepare_sample_output(samples, prepared, chains, design, PADDING, tmpdir)
+            return recoveries
+
+        recoveries, times = _timed(write, REPEATS)
+    record("write", times, designed, num_samples)
+
+    return {
+        **{key: value for key, value in scenario.items() if key != "design"},
+        "length": length,
+        "designed_positions": len(prepared.indexes),
+        "recovery": float(np.mean(recoveries)),
+        "total_time": sum(stage["time"] for stage in stages.values()),
+        "stages": stages,
+    }
+
+
+def compare(results: Dict, baseline: Dict) -> None:
+    # Time of every stage relative to the baseline (> 1 is slower)
+    previous = {scenario["name"]: scenario for scenario in baseline["scenarios"]}
+    print(f"\n> Compared to {baseline['environment']['commit']}")
+    for scenario in results["scenarios"]:
+        if scenario["name"] not in previous:
+            continue
+        stages = previous[scenario["name"]]["stages"]
+        ratios = [
+            f"{stage} {timing['time'] / stages[stage]['time']:.2f}x"
+            for stage, timing in scenario["stages"].items()
+            if stage in stages
+        ]
+        print(f"{scenario['name']:>28}: {', '.join(ratios)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the design pipeline")
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="JSON file (default: benchmarks/results/<commit>.json)",
+    )
+    parser.add_argument("--baseline", default=None, help="JSON file to compare with")
+    parser.add_argument(
+        "--compile", action="store_true", help="Compile the decoder step"
+    )
+    args = parser.parse_args()
+
+    # Load model
+    _model, _alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
+
+    # use eval mode for deterministic output e.g. without random dropout
+    _model = _model.eval()
+    if args.compile:
+        _model = compile_decoder(_model)
+    model_rss = _peak_rss_mb()
+
+    # Every scenario runs in a fresh forked process, so its peak RSS is not
+    # inflated by the previous ones
+    context = multiprocessing.get_context("fork")
+    scenarios = []
+    for scenario in _scenarios():
+        print(f"[==> {scenario['name']}")
+        with context.Pool(1) as pool:
+            scenarios.append(pool.apply(run_scenario, (scenario,)))
+        for stage, timing in scenarios[-1]["stages"].items():
+            print(
+                f"{stage:>12}: {timing['time']:.4f} s, "
+                f"{timing['residues_per_sec']:.1f} residues/s, "
+                f"{timing['peak_rss_mb']:.0f} MB"
+            )
+
+    results = {
+        "environment": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "esm": esm.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "threads": THREADS,
+            "cuda": False,
+        },
+        "settings": {
+            "temperature": TEMPERATURE,
+            "padding": PADDING,
+            "batch_size": BATCH_SIZE,
+            "seed": SEED,
+            "repeats": REPEATS,
+            "compile": args.compile,
+            "model_rss_mb": model_rss,
+        },
+        "scenarios": scenarios,
+    }
+
+    outpath = args.output
+    if outpath is None:
+        name = results["environment"]["commit"] or "pipeline"
+        outpath = os.path.join("benchmarks", "results", f"{name}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(outpath)), exist_ok=True)
+    with open(outpath, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n> Saved benchmark to {outpath}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
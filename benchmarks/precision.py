@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import warnings
+
+import pandas as pd
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+from ESMIFDesign import (
+    check_precision,
+    esm,
+    get_chains,
+    get_replicate_seeds,
+    prepare_complex,
+    read_config,
+    set_precision,
+)
+from ESMIFDesign.decoding import clear_encoder_cache, encode_structure, sample_sequences
+
+# Just suppress all warnings with this:
+warnings.filterwarnings("ignore")
+
+# CONSTANTS
+NUM_SAMPLES = 10
+TEMPERATURE = 0.2
+PADDING = 10
+BATCH_SIZE = 32
+SEED = 37
+THREADS = 4
+PRECISIONS = ["int8", "bf16"]
+
+
+def model_size_mb(model: torch.nn.Module) -> float:
+    # Bytes of parameters and buffers, including packed quantized weights
+    def size(value) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(size(item) for item in value)
+        return 0
+
+    return sum(size(value) for value in model.state_dict().values()) / 2**20
+
+
+def sampling_time(model, alphabet, prepared) -> float:
+    # Encoding and decoding of NUM_SAMPLES seeded samples of every structure
+    start = time.perf_counter()
+    for structure in prepared:
+        clear_encoder_cache()
+        encoder_out = encode_structure(model, alphabet, structure.coords)
+        sample_sequences(
+            model,
+            alphabet,
+            encoder_out,
+            structure.padding_pattern,
+            num_samples=NUM_SAMPLES,
+            temperature=TEMPERATURE,
+            batch_size=BATCH_SIZE,
+            seeds=get_replicate_seeds(SEED, structure.name, NUM_SAMPLES),
+        )
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    torch.set_num_threads(THREADS)
+
+    # Load model
+    model, alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
+
+    # use eval mode for deterministic output e.g. without random dropout
+    model = model.eval()
+
+    # Read configuration file
+    config = read_config("config.json")
+    prepared = [
+        prepare_complex(
+            os.path.join("data", f"{pdb}.pdb"), get_chains(config[pdb]), config[pdb]
+        )
+        for pdb in config
+    ]
+
+    # Accuracy of every mode against fp32 on every structure
+    accuracy = pd.concat(
+        [
+            check_precision(
+                model, alphabet, prepared, precision, NUM_SAMPLES, TEMPERATURE, SEED
+            )
+            for precision in PRECISIONS
+        ],
+        ignore_index=True,
+    )
+
+    # Throughput and memory of every mode
+    reference = sampling_time(model, alphabet, prepared)
+    rows = [{"precision": "fp32", "time": reference, "size_mb": model_size_mb(model)}]
+    for precision in PRECISIONS:
+        mode_model = set_precision(model, precision)
+        rows.append(
+            {
+                "precision": precision,
+                "time": sampling_time(mode_model, alphabet, prepared),
+                "size_mb": model_size_mb(mode_model),
+            }
+        )
+    speed = pd.DataFrame(rows)
+    speed["speedup"] = reference / speed["time"]
+
+    os.makedirs(os.path.join("benchmarks", "results"), exist_ok=True)
+    accuracy.to_csv(
+        os.path.join("benchmarks", "results", "precision_accuracy.csv"), index=False
+    )
+    speed.to_csv(
+        os.path.join("benchmarks", "results", "precision_speed.csv"), index=False
+    )
+
+    # Show summary to user
+    print(
+        accuracy.groupby("precision")[
+            ["max_logp_diff", "mean_logp_diff", "delta_recovery", "identical_residues"]
+        ].mean()
+    )
+    print(speed)
@@ -1,22 +1,45 @@
+import logging
 import os
 import warnings
+from typing import List, Optional
 
 import numpy as np
 import pandas as pd
 import torch
 
 from ESMIFDesign import (
+    DesignLedger,
+    DesignSettings,
+    DesignTask,
+    JsonLinesSink,
+    PreparedComplex,
+    ResultCache,
+    ResultWriter,
+    add_sink,
+    compile_decoder,
+    design_matrix,
     esm,
     get_chains,
-    get_frequency_of_residues,
+    get_diversity,
+    get_entropy,
+    get_frequency,
+    get_residue_probabilities,
+    get_uniqueness,
+    pdb_digest,
+    prepare_complex,
     prepare_sample_output,
     read_config,
+    run_batched,
+    run_parallel,
     sample_seq_multichain,
+    saturation_mutagenesis,
+    set_precision,
 )
 
 # Set seed
-torch.manual_seed(37)
-np.random.seed(37)
+SEED = 37
+torch.manual_seed(SEED)
+np.random.seed(SEED)
 
 # Just suppress all warnings with this:
 warnings.filterwarnings("ignore")
@@ -26,8 +49,56 @@ NUM_SAMPLES = 10
 TEMPERATURE = 0.2
 PADDING = 10
 VERBOSE = False
+BATCH_SIZE = 32
+CACHE_DIR = os.path.join(".cache", "structures")
+# Samples of seeded runs, reused (and extended) by identical runs
+RESULT_CACHE = os.path.join(".cache", "results")
+WORKERS = 1
+# Encode and decode up to BATCH_STRUCTURES structures of similar length together
+# (fixed NUM_SAMPLES only)
+BATCH_STRUCTURES = 1
+# Frequency per position: "sampled" (counts over samples), or model
+# probabilities from one teacher-forced pass with "masked_context" (earlier
+# designed positions as <mask>, an approximation) or "conditional" (native
+# residues at earlier designed positions), see get_residue_probabilities
+FREQUENCY = "sampled"
+# Adaptive sampling: draw blocks of NUM_SAMPLES until residue frequencies change
+# by less than TOLERANCE, up to MAX_SAMPLES (None for a fixed NUM_SAMPLES). The
+# convergence trace is saved to results/<pdb>_convergence.csv
+TOLERANCE = None
+MAX_SAMPLES = 500
+# Sample NUM_SAMPLES distinct designs per structure, rejecting duplicates (up to
+# MAX_SAMPLES draws)
+UNIQUE = False
+# Ledger of completed structures, so an interrupted run resumes where it stopped
+# (None to disable)
+LEDGER = os.path.join("results", "ledger.sqlite")
+# Stream designs to a Parquet file (requires pyarrow) instead of writing CSV and
+# FASTA files per structure, e.g. os.path.join("results", "designs.parquet")
+RESULTS_FILE = None
+# Also store the full sequence of the target chains of every sample
+FULL_SEQUENCE = False
+# Score all 20 residues at every designed position (results/<pdb>_mutagenesis.csv)
+MUTAGENESIS = False
+# Precision of the model on CPU: "fp32", "int8" (dynamic quantization of the
+# transformer linear layers) or "bf16" (autocast), see benchmarks/precision.py
+PRECISION = "fp32"
+# Compile the decoder step with torch.compile (torch>=2.0). Compiled kernels are
+# cached in COMPILE_CACHE, so only the first run pays the compile time
+COMPILE = False
+COMPILE_CACHE = os.path.join(".cache", "compile")
+# Append stage timings (load, prepare, encode, decode, recovery, write) as JSON
+# lines, e.g. os.path.join("results", "profile.jsonl") (None to disable)
+PROFILE = None
 
 if __name__ == "__main__":
+    # Progress messages (and every sampled sequence with VERBOSE)
+    logging.basicConfig(
+        level=logging.DEBUG if VERBOSE else logging.INFO, format="%(message)s"
+    )
+    if PROFILE is not None:
+        add_sink(JsonLinesSink(PROFILE))
+
     # UserWarning: Regression weights not found, predicting contacts will not produce correct results.
     # @tomsercu: You don't need the regression weights, these are for contact prediction only. They are not uploaded on purpose to prevent folks from inadvertently using esm-1v for contact prediction which will lead to poor results, as discussed in the paper.
     # https://github.com/facebookresearch/esm/issues/170#issuecomment-1076687163
@@ -35,6 +106,9 @@ if __name__ == "__main__":
 
     # use eval mode for deterministic output e.g. without random dropout
     model = model.eval()
+    model = set_precision(model, PRECISION)
+    if COMPILE:
+        model = compile_decoder(model, COMPILE_CACHE)
 
     # Read configuration file
     config = read_config("config.json")
@@ -45,58 +119,222 @@ if __name__ == "__main__":
     summary["recovery"] = {}
     summary["uniqueness"] = {}
     summary["frequency"] = {}
+    summary["diversity"] = {}
 
-    # Iterate through all PDB files
-    for pdb in config:
-        print(f"[==> {pdb}")
+    # Prepare one task per PDB file
+    basedir = os.path.join("results")
+    tasks = [
+        DesignTask(
+            pdb,
+            os.path.join("data", f"{pdb}.pdb"),
+            config[pdb],
+            os.path.join(basedir, f"{pdb}.fasta") if RESULTS_FILE is None else None,
+            basedir if RESULTS_FILE is None else None,
+        )
+        for pdb in config
+    ]
+    settings = DesignSettings(
+        NUM_SAMPLES,
+        TEMPERATURE,
+        PADDING,
+        BATCH_SIZE,
+        SEED,
+        CACHE_DIR,
+        TOLERANCE,
+        MAX_SAMPLES,
+        UNIQUE,
+        RESULT_CACHE,
+        # Convergence traces are kept even when designs go to RESULTS_FILE
+        trace_dir=basedir,
+    )
 
-        # Prepare parameters
-        basedir = os.path.join("results")
-        pdbfile = os.path.join("data", f"{pdb}.pdb")
-        outpath = os.path.join(basedir, f"{pdb}.fasta")
-        design = config[pdb]
-        chains = get_chains(design)
+    # Stream designs of every structure to a single file
+    writer = None
+    if RESULTS_FILE is not None:
+        writer = ResultWriter(RESULTS_FILE, full_sequence=FULL_SEQUENCE)
 
-        # Sampling sequences
-        samples, recoveries = sample_seq_multichain(
-            model,
-            alphabet,
-            pdbfile,
-            chains,
-            design,
-            outpath,
-            NUM_SAMPLES,
-            TEMPERATURE,
-            PADDING,
-            VERBOSE,
-        )
+    def summarize(
+        task: DesignTask,
+        designs: List[str],
+        recoveries: List[float],
+        prepared: Optional[PreparedComplex] = None,
+    ) -> None:
+        # Summarize each structure as soon as it is done, so designs are not
+        # kept in memory when streamed to RESULTS_FILE
+        pdb = task.pdb
+        if prepared is None and (
+            writer is not None or FREQUENCY != "sampled" or MUTAGENESIS
+        ):
+            prepared = prepare_complex(
+                task.pdbfile, get_chains(task.design), task.design, PADDING, CACHE_DIR
+            )
 
-        # Save samples
-        summary["design"][pdb] = prepare_sample_output(
-            samples, pdbfile, chains, design, PADDING, basedir
-        )
+        if writer is None:
+            # Save samples
+            summary["design"][pdb] = designs
 
-        # Save recovery
-        summary["recovery"][pdb] = recoveries
+            # Save recovery
+            summary["recovery"][pdb] = recoveries
+        else:
+            writer.write(prepared, designs, recoveries, TEMPERATURE)
+
+        # Designs as a [samples, positions] residue matrix
+        matrix = design_matrix(designs)
 
         # Save uniqueness
         # Uniqueness = number of unique designs / total number of designs
-        summary["uniqueness"][pdb] = [
-            len(list(set(summary["design"][pdb]))) / NUM_SAMPLES
+        summary["uniqueness"][pdb] = [get_uniqueness(matrix)]
+
+        # Save diversity (mean pairwise Hamming distance and mean entropy per
+        # position, in bits)
+        summary["diversity"][pdb] = [
+            get_diversity(matrix),
+            float(get_entropy(matrix).mean()) if matrix.shape[1] > 0 else 0.0,
         ]
 
         # Save frequency per position
-        summary["frequency"][pdb] = get_frequency_of_residues(
-            summary["design"][pdb], NUM_SAMPLES
+        if FREQUENCY == "sampled":
+            summary["frequency"][pdb] = get_frequency(matrix)
+        else:
+            # Model probabilities from one teacher-forced pass
+            summary["frequency"][pdb] = get_residue_probabilities(
+                model, alphabet, prepared, TEMPERATURE, FREQUENCY
+            )
+
+        # Save position x amino acid change in log-likelihood
+        if MUTAGENESIS:
+            saturation_mutagenesis(model, alphabet, prepared, basedir)
+
+    # Skip structures already completed by a previous run with the same settings
+    # and the same structure files
+    ledger = DesignLedger(LEDGER) if LEDGER is not None else None
+    fingerprint, digests = None, {}
+    if ledger is not None:
+        fingerprint = settings.fingerprint(model)
+        digests = {task.pdb: pdb_digest(task.pdbfile) for task in tasks}
+    pending, completed = [], []
+    for task in tasks:
+        result = None
+        if ledger is not None:
+            result = ledger.get(
+                task.pdb,
+                task.design,
+                TEMPERATURE,
+                NUM_SAMPLES,
+                SEED,
+                basedir,
+                fingerprint,
+                digests[task.pdb],
+            )
+        if result is not None:
+            print(f"[==> {task.pdb} (completed, skipped)")
+            completed.append((task, result))
+        else:
+            pending.append(task)
+    tasks_by_pdb = {task.pdb: task for task in tasks}
+
+    def record(
+        pdb: str,
+        designs: List[str],
+        recoveries: List[float],
+        prepared: Optional[PreparedComplex] = None,
+    ) -> None:
+        # Store each structure as soon as it is done
+        if ledger is not None:
+            ledger.record(
+                pdb,
+                config[pdb],
+                TEMPERATURE,
+                NUM_SAMPLES,
+                SEED,
+                designs,
+                recoveries,
+                basedir,
+                fingerprint,
+                digests[pdb],
+            )
+        summarize(tasks_by_pdb[pdb], designs, recoveries, prepared)
+
+    if BATCH_STRUCTURES > 1:
+        # Sample structures of similar length in shared batches
+        run_batched(
+            model,
+            alphabet,
+            pending,
+            settings,
+            max_structures=BATCH_STRUCTURES,
+            on_result=record,
         )
+    elif WORKERS > 1:
+        # Sample structures in parallel worker processes
+        run_parallel(model, alphabet, pending, settings, WORKERS, on_result=record)
+    else:
+        # Iterate through all PDB files
+        cache = ResultCache(RESULT_CACHE) if RESULT_CACHE is not None else None
+        for task in pending:
+            print(f"[==> {task.pdb}")
+            chains = get_chains(task.design)
+
+            # Parse structure once for sampling and output
+            prepared = prepare_complex(
+                task.pdbfile, chains, task.design, PADDING, CACHE_DIR
+            )
+
+            # Sampling sequences
+            samples, recoveries = sample_seq_multichain(
+                model,
+                alphabet,
+                prepared,
+                chains,
+                task.design,
+                task.outpath,
+                NUM_SAMPLES,
+                TEMPERATURE,
+                PADDING,
+                VERBOSE,
+                BATCH_SIZE,
+                seed=SEED,
+                tolerance=TOLERANCE,
+                max_samples=MAX_SAMPLES,
+                unique=UNIQUE,
+                cache=cache,
+                trace_dir=basedir,
+            )
+
+            # Save samples
+            designs = prepare_sample_output(
+                samples, prepared, chains, task.design, PADDING, task.basedir
+            )
+            record(task.pdb, designs, recoveries, prepared)
+
+    if ledger is not None:
+        ledger.close()
 
-    # Convert designs to pandas DataFrame
-    samples = pd.DataFrame(summary["design"])
-    samples.to_csv(os.path.join(basedir, "designs.csv"))
+    # Structures completed by a previous run are summarized after sampling, so
+    # the model is not used before workers are forked (see run_parallel)
+    for task, (designs, recoveries) in completed:
+        summarize(task, designs, recoveries)
 
-    # Convert recoveries to pandas DataFrame
-    recoveries = pd.DataFrame(summary["recovery"])
-    recoveries.to_csv(os.path.join(basedir, "recoveries.csv"))
+    if writer is not None:
+        writer.close()
+        print(f"> Saved designs to {RESULTS_FILE}")
+
+    # Structures in configuration order, whatever the completion order
+    summary = {
+        key: {task.pdb: values[task.pdb] for task in tasks if task.pdb in values}
+        for key, values in summary.items()
+    }
+
+    # Convert designs to pandas DataFrame (structures may have a different
+    # number of samples in adaptive mode)
+    # (already in RESULTS_FILE when streaming)
+    if writer is None:
+        samples = pd.DataFrame.from_dict(summary["design"], orient="index").T
+        samples.to_csv(os.path.join(basedir, "designs.csv"))
+
+        # Convert recoveries to pandas DataFrame
+        recoveries = pd.DataFrame.from_dict(summary["recovery"], orient="index").T
+        recoveries.to_csv(os.path.join(basedir, "recoveries.csv"))
 
     # Convert uniqueness to pandas DataFrame
     uniqueness = pd.DataFrame(summary["uniqueness"])
@@ -105,5 +343,10 @@ if __name__ == "__main__":
     # Convert frequency to pandas DataFrame
     frequency = pd.DataFrame(summary["frequency"])
     frequency.to_csv(os.path.join(basedir, "frequency.csv"))
+
+    # Convert diversity to pandas DataFrame
+    diversity = pd.DataFrame(summary["diversity"], index=["hamming", "entropy"])
+    diversity.to_csv(os.path.join(basedir, "diversity.csv"))
+
     # Show summary to user
     print(summary)
@@ -0,0 +1,83 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("esm")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ESMIFDesign.esmif import _crop_around_design
+
+# Synthetic complexes: residues of a chain are 3.8 A apart along x, chains are
+# 100 A apart along y, so only residues of the same chain are within radius
+
+
+def _complex(chain_sizes, padding_length):
+    # Coordinates [L, 3, 3] and padding pattern of the concatenated chains
+    coords, pattern = [], []
+    for chain, size in enumerate(chain_sizes):
+        if chain > 0:
+            coords.append(np.full((padding_length, 3, 3), np.nan, dtype=np.float32))
+            pattern += ["<pad>"] * padding_length
+        residues = np.zeros((size, 3, 3), dtype=np.float32)
+        residues[:, :, 0] = 3.8 * np.arange(size)[:, None]
+        residues[:, :, 1] = 100.0 * chain
+        coords.append(residues)
+        pattern += ["A"] * size
+    return np.concatenate(coords), pattern
+
+
+def _design(pattern, indexes):
+    pattern = list(pattern)
+    for index in indexes:
+        pattern[index] = "<mask>"
+    return pattern
+
+
+def test_crop_remaps_design_indexes():
+    coords, pattern = _complex([20, 20], 5)
+    indexes = [10, 35]
+    pattern = _design(pattern, indexes)
+
+    cropped_coords, cropped_pattern, cropped_indexes = _crop_around_design(
+        coords, pattern, indexes, [20, 20], radius=4.0, margin=0, padding_length=5
+    )
+
+    # Neighbours within radius (9-11 and 34-36) joined by one padding
+    assert cropped_pattern == (
+        ["A", "<mask>", "A"] + ["<pad>"] * 5 + ["A", "<mask>", "A"]
+    )
+    assert cropped_indexes == [1, 9]
+    for index, cropped in zip(indexes, cropped_indexes):
+        np.testing.assert_array_equal(cropped_coords[cropped], coords[index])
+    assert np.isnan(cropped_coords[3:8]).all()
+
+
+def test_crop_margin_extends_along_chain():
+    coords, pattern = _complex([20], 5)
+    pattern = _design(pattern, [10])
+
+    _, cropped_pattern, cropped_indexes = _crop_around_design(
+        coords, pattern, [10], [20], radius=1.0, margin=2, padding_length=5
+    )
+
+    # Only the design residue is within radius, extended by 2 on each side
+    assert cropped_pattern == ["A", "A", "<mask>", "A", "A"]
+    assert cropped_indexes == [2]
+
+
+@pytest.mark.parametrize("padding_length", [0, 1, 10])
+def test_crop_margin_stops_at_chain_end(padding_length):
+    coords, pattern = _complex([10, 10], padding_length)
+    pattern = _design(pattern, [9])
+
+    _, cropped_pattern, cropped_indexes = _crop_around_design(
+        coords, pattern, [9], [10, 10], 1.0, margin=3, padding_length=padding_length
+    )
+
+    # Margin of the last residue of the first chain never reaches the second
+    assert cropped_pattern == ["A", "A", "A", "<mask>"]
+    assert cropped_indexes == [3]
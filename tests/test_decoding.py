@@ -0,0 +1,111 @@
+import json
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+esm = pytest.importorskip("esm")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ESMIFDesign import get_chains, prepare_complex
+from ESMIFDesign.decoding import (
+    DecoderState,
+    _decode_chunk,
+    _position_table,
+    encode_structure,
+    forward_logits,
+    sample_sequences,
+    tokenize,
+)
+from ESMIFDesign.scoring import _native_pattern
+
+# Incremental decoding is checked against the full (non-incremental) fair-esm
+# decoder and sampler on one complex of data/
+PDB = "6zkw"
+PADDING = 10
+CHUNK = 7
+
+
+@pytest.fixture(scope="module")
+def esm_if1():
+    model, alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
+    return model.eval(), alphabet
+
+
+@pytest.fixture(scope="module")
+def prepared():
+    with open(os.path.join(ROOT, "config.json"), "r") as f:
+        design = json.load(f)[PDB]
+    pdbfile = os.path.join(ROOT, "data", f"{PDB}.pdb")
+    return prepare_complex(pdbfile, get_chains(design), design, PADDING)
+
+
+@torch.no_grad()
+def _full_logits(model, alphabet, prepared):
+    # Encoder output, tokens [1, 1 + L] of the native sequence and logits
+    # [1 + L, V] of one non-incremental decoder pass (logits at i predict token
+    # i + 1)
+    encoder_out = encode_structure(model, alphabet, prepared.coords)
+    tokens = tokenize(alphabet, _native_pattern(prepared), "cpu")
+    logits, _ = model.decoder(tokens, encoder_out)
+    return encoder_out, tokens, logits[0].transpose(0, 1)
+
+
+def test_forward_logits(esm_if1, prepared):
+    model, alphabet = esm_if1
+    encoder_out, tokens, full = _full_logits(model, alphabet, prepared)
+    targets = [index + 1 for index in prepared.indexes]
+
+    logits = forward_logits(model, alphabet, encoder_out, tokens, targets)[0]
+
+    expected = full[[target - 1 for target in targets]]
+    assert torch.allclose(logits, expected, atol=1e-4, rtol=1e-4)
+
+
+@torch.no_grad()
+def test_decode_chunk(esm_if1, prepared):
+    model, alphabet = esm_if1
+    encoder_out, tokens, full = _full_logits(model, alphabet, prepared)
+    targets = [index + 1 for index in prepared.indexes]
+    length = tokens.size(1)
+    positions = _position_table(model, alphabet, length, "cpu")
+
+    # Teacher-force the whole sequence in chunks through the decoder cache
+    state = DecoderState(encoder_out)
+    chunks = []
+    for start in range(0, length, CHUNK):
+        chunk = tokens[:, start : start + CHUNK]
+        outputs = torch.arange(chunk.size(1))
+        chunks.append(_decode_chunk(model, state, chunk, positions, outputs))
+    logits = torch.cat(chunks, dim=1)[0]
+
+    rows = [target - 1 for target in targets]
+    assert state.length == length
+    assert torch.allclose(logits[rows], full[rows], atol=1e-4, rtol=1e-4)
+
+
+def test_sample_sequences_argmax(esm_if1, prepared):
+    model, alphabet = esm_if1
+    temperature = 1e-6
+    encoder_out = encode_structure(model, alphabet, prepared.coords)
+
+    tokens = sample_sequences(
+        model,
+        alphabet,
+        encoder_out,
+        prepared.padding_pattern,
+        num_samples=1,
+        temperature=temperature,
+    )
+    sampled = "".join(alphabet.get_tok(token) for token in tokens[0].tolist())
+
+    # Reference sampler of fair-esm (argmax at this temperature)
+    expected = model.sample(
+        prepared.coords,
+        partial_seq=prepared.padding_pattern,
+        temperature=temperature,
+    )
+    assert sampled == expected
@@ -0,0 +1,84 @@
+import itertools
+import os
+import sys
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("esm")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ESMIFDesign.stats import (
+    AMINO_ACIDS,
+    design_matrix,
+    get_diversity,
+    get_entropy,
+    get_frequency,
+    get_recovery,
+    get_uniqueness,
+)
+from ESMIFDesign.utils import get_frequency_of_residues
+
+# Vectorized statistics are checked against the loop versions they replaced
+
+
+@pytest.fixture
+def designs():
+    # Low-diversity designs, so duplicates and repeated residues are frequent
+    rng = np.random.default_rng(37)
+    residues = np.array(list("ACDEG"))
+    return ["".join(rng.choice(residues, size=12)) for _ in range(50)]
+
+
+def test_frequency(designs):
+    expected = {
+        aa: [item.count(aa) / len(designs) for item in zip(*designs)]
+        for aa in AMINO_ACIDS
+    }
+    frequency = get_frequency(design_matrix(designs))
+    assert list(frequency) == AMINO_ACIDS
+    for aa in AMINO_ACIDS:
+        np.testing.assert_allclose(frequency[aa], expected[aa])
+
+    # get_frequency_of_residues keeps its layout and num_samples argument
+    frequency = get_frequency_of_residues(designs, 2 * len(designs))
+    for aa in AMINO_ACIDS:
+        np.testing.assert_allclose(frequency[aa], np.array(expected[aa]) / 2)
+
+
+def test_recovery(designs):
+    native = designs[0][::-1]
+    expected = [np.mean([a == b for a, b in zip(native, s)]) for s in designs]
+    np.testing.assert_allclose(get_recovery(design_matrix(designs), native), expected)
+
+
+def test_uniqueness(designs):
+    designs = designs + designs[:10]
+    expected = len(list(set(designs))) / len(designs)
+    assert get_uniqueness(design_matrix(designs)) == pytest.approx(expected)
+
+
+def test_diversity(designs):
+    distances = [
+        sum(a != b for a, b in zip(s, t))
+        for s, t in itertools.permutations(designs, 2)
+    ]
+    assert get_diversity(design_matrix(designs)) == pytest.approx(np.mean(distances))
+
+
+def test_entropy(designs):
+    expected = []
+    for column in zip(*designs):
+        probs = np.array(list(Counter(column).values())) / len(designs)
+        expected.append(-(probs * np.log2(probs)).sum())
+    np.testing.assert_allclose(get_entropy(design_matrix(designs)), expected)
+
+
+def test_empty():
+    matrix = design_matrix([])
+    assert matrix.shape == (0, 0)
+    assert get_uniqueness(matrix) == 0.0
+    assert get_diversity(matrix) == 0.0
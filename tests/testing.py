@@ -1,7 +1,8 @@
+import logging
 import os
 import sys
 import warnings
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
@@ -12,13 +13,21 @@ from esm.inverse_folding.gvp_transformer import GVPTransformerModel
 sys.path.append("../")
 
 from ESMIFDesign import (
+    DesignLedger,
+    DesignSettings,
+    PreparedComplex,
+    ResultCache,
     esm,
     get_chains,
     get_frequency_of_residues,
+    pdb_digest,
+    prepare_complex,
     prepare_sample_output,
     read_config,
     sample_seq_multichain,
+    sample_temperature_sweep,
 )
+from ESMIFDesign.esmif import write_fasta
 
 # Set seed
 torch.manual_seed(37)
@@ -32,6 +41,87 @@ NUM_SAMPLES = 10
 TEMPERATURE = 0.2
 PADDING = 10
 VERBOSE = False
+BATCH_SIZE = 32
+CACHE_DIR = os.path.join(".cache", "structures")
+LEDGER = os.path.join("results", "ledger.sqlite")
+# Experiments repeat identical runs (e.g. 10 samples are the first 10 of 500)
+SEED = 37
+RESULT_CACHE = ResultCache(os.path.join(".cache", "results"))
+
+
+def unit_settings(
+    model: GVPTransformerModel, num_samples: int, temperature: float
+) -> Dict[str, Any]:
+    # Settings that change the designs of a ledger unit
+    settings = DesignSettings(num_samples, temperature, PADDING, BATCH_SIZE, SEED)
+    return settings.fingerprint(model)
+
+
+def sample_unit(
+    model: GVPTransformerModel,
+    alphabet: Alphabet,
+    ledger: DesignLedger,
+    prepared: PreparedComplex,
+    outpath: str,
+    basedir: Optional[str],
+    num_samples: int,
+    temperature: float,
+    scope: Optional[str] = None,
+) -> Tuple[List[str], List[float]]:
+    # Units completed by a previous run with the same settings are read from
+    # the ledger
+    scope = basedir if scope is None else scope
+    settings = unit_settings(model, num_samples, temperature)
+    digest = pdb_digest(prepared.pdbfile)
+    result = ledger.get(
+        prepared.name,
+        prepared.design,
+        temperature,
+        num_samples,
+        SEED,
+        scope,
+        settings,
+        digest,
+    )
+    if result is not None:
+        print("> Completed, skipped")
+        return result
+
+    # Sampling sequences
+    samples, recoveries = sample_seq_multichain(
+        model,
+        alphabet,
+        prepared,
+        prepared.chains,
+        prepared.design,
+        outpath,
+        num_samples,
+        temperature,
+        PADDING,
+        VERBOSE,
+        BATCH_SIZE,
+        seed=SEED,
+        cache=RESULT_CACHE,
+    )
+
+    # Save samples
+    designs = prepare_sample_output(
+        samples, prepared, prepared.chains, prepared.design, PADDING, basedir
+    )
+    ledger.record(
+        prepared.name,
+        prepared.design,
+        temperature,
+        num_samples,
+        SEED,
+        designs,
+        recoveries,
+        scope,
+        settings,
+        digest,
+    )
+
+    return designs, recoveries
 
 
 def testing_6ZKW(model: GVPTransformerModel, alphabet: Alphabet):
@@ -59,18 +149,19 @@ def testing_6ZKW(model: GVPTransformerModel, alphabet: Alphabet):
         )
 
         # Sampling sequences
-        samples, recoveries = sample_seq_multichain(
-            model,
-            alphabet,
-            pdbfile,
-            chains,
-            design,
-            outpath,
-            NUM_SAMPLES,
-            TEMPERATURE,
-            PADDING,
-            VERBOSE,
-        )
+        prepared = prepare_complex(pdbfile, chains, design, PADDING, CACHE_DIR)
+        with DesignLedger(LEDGER) as ledger:
+            _, recoveries = sample_unit(
+                model,
+                alphabet,
+                ledger,
+                prepared,
+                outpath,
+                None,
+                NUM_SAMPLES,
+                TEMPERATURE,
+                scope=os.path.join("results", "6ZKW"),
+            )
 
         # Append recoveries to summary
         recoveries.append(sum(recoveries) / len(recoveries))
@@ -116,32 +207,27 @@ def testing_pMHC(model: GVPTransformerModel, alphabet: Alphabet):
             design = config[pdb]
             chains = get_chains(design)
 
+            # Parse structure once for sampling and output
+            prepared = prepare_complex(pdbfile, chains, design, PADDING, CACHE_DIR)
+
             # Sampling sequences
-            samples, recoveries = sample_seq_multichain(
-                model,
-                alphabet,
-                pdbfile,
-                chains,
-                design,
-                outpath,
-                NUM_SAMPLES,
-                TEMPERATURE,
-                PADDING,
-                VERBOSE,
-            )
+            with DesignLedger(LEDGER) as ledger:
+                designs, recoveries = sample_unit(
+                    model,
+                    alphabet,
+                    ledger,
+                    prepared,
+                    outpath,
+                    os.path.join(basedir, datatype),
+                    NUM_SAMPLES,
+                    TEMPERATURE,
+                )
 
             # Save recovery
             summary[datatype][pdb] = recoveries
 
             # Save samples
-            summary[datatype]["design"][pdb] = prepare_sample_output(
-                samples,
-                pdbfile,
-                chains,
-                design,
-                PADDING,
-                os.path.join(basedir, datatype),
-            )
+            summary[datatype]["design"][pdb] = designs
 
             # Save recovery
             summary[datatype]["recovery"][pdb] = recoveries
@@ -183,80 +269,153 @@ def testing_temperature(
     # Read configuration file
     config = read_config("temperature.json")
 
-    # Create directory
-    os.makedirs(os.path.join("results", "temperatures"), exist_ok=True)
-
+    # Create directories
     for temperature in temperatures:
-        print(f"\n=== {temperature} ===\n")
         os.makedirs(
             os.path.join("results", "temperatures", f"{temperature}"), exist_ok=True
         )
 
-        # Create summary
-        summary = {}
-        summary["design"] = {}
-        summary["recovery"] = {}
-        summary["uniqueness"] = {}
-        summary["frequency"] = {}
+    # Create summary per temperature
+    summary = {
+        temperature: {"design": {}, "recovery": {}, "uniqueness": {}, "frequency": {}}
+        for temperature in temperatures
+    }
 
-        # Iterate through all PDB files
-        for pdb in config:
-            print(f"[==> {pdb}")
+    # Sample every temperature from one encoding of each structure
+    sweeps = []
+    for pdb in config:
+        print(f"[==> {pdb}")
 
-            # Prepare parameters
-            basedir = os.path.join("results", "temperatures", f"{temperature}")
-            pdbfile = os.path.join("data", "dataset", f"{pdb}.pdb")
-            outpath = os.path.join(basedir, f"{pdb}.fasta")
-            design = config[pdb]
-            chains = get_chains(design)
+        # Prepare parameters
+        pdbfile = os.path.join("data", "dataset", f"{pdb}.pdb")
+        design = config[pdb]
+        chains = get_chains(design)
+        prepared = prepare_complex(pdbfile, chains, design, PADDING, CACHE_DIR)
+        basedirs = {
+            temperature: os.path.join("results", "temperatures", f"{temperature}")
+            for temperature in temperatures
+        }
 
-            # Sampling sequences
-            samples, recoveries = sample_seq_multichain(
-                model,
-                alphabet,
-                pdbfile,
-                chains,
-                design,
-                outpath,
-                NUM_SAMPLES,
-                temperature,
-                PADDING,
-                VERBOSE,
+        settings = {
+            temperature: unit_settings(model, NUM_SAMPLES, temperature)
+            for temperature in temperatures
+        }
+        digest = pdb_digest(pdbfile)
+
+        with DesignLedger(LEDGER) as ledger:
+            # Temperatures completed by a previous run are read from the ledger
+            results = {
+                temperature: ledger.get(
+                    pdb,
+                    design,
+                    temperature,
+                    NUM_SAMPLES,
+                    SEED,
+                    basedirs[temperature],
+                    settings[temperature],
+                    digest,
+                )
+                for temperature in temperatures
+            }
+
+            # Sampling sequences at all temperatures
+            if any(result is None for result in results.values()):
+                sweep = sample_temperature_sweep(
+                    model,
+                    alphabet,
+                    prepared,
+                    chains,
+                    design,
+                    temperatures,
+                    NUM_SAMPLES,
+                    PADDING,
+                    BATCH_SIZE,
+                    seed=SEED,
+                )
+                for temperature in temperatures:
+                    group = sweep[sweep["temperature"] == temperature]
+                    basedir = basedirs[temperature]
+                    samples = group["sample"].tolist()
+
+                    # Save samples
+                    write_fasta(
+                        os.path.join(basedir, f"{pdb}.fasta"),
+                        prepared.native_seq,
+                        samples,
+                    )
+                    designs = prepare_sample_output(
+                        samples, prepared, chains, design, PADDING, basedir
+                    )
+                    recoveries = group["recovery"].tolist()
+                    ledger.record(
+                        pdb,
+                        design,
+                        temperature,
+                        NUM_SAMPLES,
+                        SEED,
+                        designs,
+                        recoveries,
+                        basedir,
+                        settings[temperature],
+                        digest,
+                    )
+                    results[temperature] = (designs, recoveries)
+            else:
+                print("> Completed, skipped")
+
+        for temperature in temperatures:
+            designs, recoveries = results[temperature]
+            sweeps.append(
+                pd.DataFrame(
+                    {
+                        "pdb": pdb,
+                        "temperature": temperature,
+                        "replicate": range(1, len(designs) + 1),
+                        "design": designs,
+                        "recovery": recoveries,
+                    }
+                )
             )
 
             # Save samples
-            summary["design"][pdb] = prepare_sample_output(
-                samples, pdbfile, chains, design, PADDING, basedir
-            )
+            summary[temperature]["design"][pdb] = designs
 
             # Save recovery
-            summary["recovery"][pdb] = recoveries
+            summary[temperature]["recovery"][pdb] = recoveries
 
             # Save uniqueness
             # Uniqueness = number of unique designs / total number of designs
-            summary["uniqueness"][pdb] = [
-                len(list(set(summary["design"][pdb]))) / NUM_SAMPLES
+            summary[temperature]["uniqueness"][pdb] = [
+                len(list(set(summary[temperature]["design"][pdb]))) / NUM_SAMPLES
             ]
 
             # Save frequency per position
-            summary["frequency"][pdb] = get_frequency_of_residues(
-                summary["design"][pdb], NUM_SAMPLES
+            summary[temperature]["frequency"][pdb] = get_frequency_of_residues(
+                summary[temperature]["design"][pdb], NUM_SAMPLES
             )
 
+    # All temperatures in one table
+    pd.concat(sweeps, ignore_index=True).to_csv(
+        os.path.join("results", "temperatures", "sweep.csv"), index=False
+    )
+
+    for temperature in temperatures:
+        basedir = os.path.join("results", "temperatures", f"{temperature}")
+
         # Convert designs to pandas DataFrame
-        samples = pd.DataFrame(summary["design"])
+        samples = pd.DataFrame(summary[temperature]["design"])
         samples.to_csv(os.path.join(basedir, "designs.csv"))
 
         # Convert recoveries to pandas DataFrame
-        recoveries = pd.DataFrame(summary["recovery"])
+        recoveries = pd.DataFrame(summary[temperature]["recovery"])
         recoveries.to_csv(os.path.join(basedir, "recoveries.csv"))
 
         # Convert uniqueness to pandas DataFrame
-        uniqueness = pd.DataFrame(summary["uniqueness"])
+        uniqueness = pd.DataFrame(summary[temperature]["uniqueness"])
         uniqueness.to_csv(os.path.join(basedir, "uniqueness.csv"))
 
         # Convert frequency to pandas DataFrame
-        frequency = pd.DataFrame(summary["frequency"])
+        frequency = pd.DataFrame(summary[temperature]["frequency"])
         frequency.to_csv(os.path.join(basedir, "frequency.csv"))
 
 
@@ -270,6 +429,14 @@ def testing_sampling(
     # Create directory
     os.makedirs(os.path.join("results", "sampling"), exist_ok=True)
 
+    # Parse each structure once for every condition
+    prepared = {}
+    for pdb in config:
+        pdbfile = os.path.join("data", "dataset", f"{pdb}.pdb")
+        prepared[pdb] = prepare_complex(
+            pdbfile, get_chains(config[pdb]), config[pdb], PADDING, CACHE_DIR
+        )
+
     for num_sample in num_samples:
         print(f"\n=== {num_sample} ===\n")
         os.makedirs(os.path.join("results", "sampling", f"{num_sample}"), exist_ok=True)
@@ -287,29 +454,23 @@ def testing_sampling(
 
             # Prepare parameters
             basedir = os.path.join("results", "sampling", f"{num_sample}")
-            pdbfile = os.path.join("data", "dataset", f"{pdb}.pdb")
             outpath = os.path.join(basedir, f"{pdb}.fasta")
-            design = config[pdb]
-            chains = get_chains(design)
 
             # Sampling sequences
-            samples, recoveries = sample_seq_multichain(
-                model,
-                alphabet,
-                pdbfile,
-                chains,
-                design,
-                outpath,
-                num_sample,
-                TEMPERATURE,
-                PADDING,
-                VERBOSE,
-            )
+            with DesignLedger(LEDGER) as ledger:
+                designs, recoveries = sample_unit(
+                    model,
+                    alphabet,
+                    ledger,
+                    prepared[pdb],
+                    outpath,
+                    basedir,
+                    num_sample,
+                    TEMPERATURE,
+                )
 
             # Save samples
-            summary["design"][pdb] = prepare_sample_output(
-                samples, pdbfile, chains, design, PADDING, basedir
-            )
+            summary["design"][pdb] = designs
 
             # Save recovery
             summary["recovery"][pdb] = recoveries
@@ -388,26 +549,24 @@ def testing_design_approaches(model: GVPTransformerModel, alphabet: Alphabet):
             design = config[pdb]
             chains = get_chains(design)
 
+            # Parse structure once for sampling and output
+            prepared = prepare_complex(pdbfile, chains, design, PADDING, CACHE_DIR)
+
             # Sampling sequences
-            samples, recoveries = sample_seq_multichain(
-                model,
-                alphabet,
-                pdbfile,
-                chains,
-                design,
-                outpath,
-                NUM_SAMPLES,
-                TEMPERATURE,
-                PADDING,
-                VERBOSE,
-            )
+            with DesignLedger(LEDGER) as ledger:
+                designs, recoveries = sample_unit(
+                    model,
+                    alphabet,
+                    ledger,
+                    prepared,
+                    outpath,
+                    basedir,
+                    NUM_SAMPLES,
+                    TEMPERATURE,
+                )
 
             # Save samples
-            summary[approach.replace(".json", "")]["design"][pdb] = (
-                prepare_sample_output(
-                    samples, pdbfile, chains, design, PADDING, basedir
-                )
-            )
+            summary[approach.replace(".json", "")]["design"][pdb] = designs
 
             # Save recovery
             summary[approach.replace(".json", "")]["recovery"][pdb] = recoveries
@@ -444,6 +603,11 @@ def testing_design_approaches(model: GVPTransformerModel, alphabet: Alphabet):
 
 
 if __name__ == "__main__":
+    # Progress messages (and every sampled sequence with VERBOSE)
+    logging.basicConfig(
+        level=logging.DEBUG if VERBOSE else logging.INFO, format="%(message)s"
+    )
+
     # Load model
     model, alphabet = esm.pretrained.esm_if1_gvp4_t16_142M_UR50()
 